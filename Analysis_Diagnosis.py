@@ -1,12 +1,22 @@
 import os
 import json
-from datetime import datetime
-from opensearchpy import OpenSearch, RequestsHttpConnection
+import functools
+import hashlib
+import weakref
+import time
+import orjson
+import tiktoken
+from datetime import datetime, timedelta, timezone
+from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
+from opensearch_serializer import OrjsonSerializer
 import asyncio
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp.types import Tool as MCPTool
 from langchain_openai import ChatOpenAI
-from langchain.agents import AgentType, initialize_agent
-from langchain_community.callbacks import get_openai_callback
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.callbacks import AsyncCallbackHandler
 import re
 from dotenv import load_dotenv
 
@@ -15,6 +25,44 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Max number of groups diagnosed in parallel by run_diagnosis_workflow (DIAG_CONCURRENCY is accepted as a short alias)
+DIAGNOSE_CONCURRENCY = int(os.getenv("DIAGNOSE_CONCURRENCY") or os.getenv("DIAG_CONCURRENCY") or "8")
+# Token budget for the JSON context embedded in the diagnosis prompt
+CONTEXT_MAX_TOKENS = int(os.getenv("DIAG_CONTEXT_MAX_TOKENS", "8000"))
+# Hard per-field caps applied before the token budget (they work even when the tokenizer is unavailable)
+DIAG_LOG_CHARS = int(os.getenv("DIAG_LOG_CHARS", "4096"))
+DIAG_SIG_TOPK = int(os.getenv("DIAG_SIG_TOPK", "20"))
+# MCP tool schemas are cached on disk (per server URL) so restarts skip the ListTools round-trip
+MCP_TOOLS_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "identifiai", "mcp_tools.json")
+MCP_TOOLS_CACHE_TTL = int(os.getenv("MCP_TOOLS_CACHE_TTL", "300"))
+# The in-process agent is rebuilt after this many seconds so MCP tool changes are picked up
+AGENT_CACHE_TTL = int(os.getenv("AGENT_CACHE_TTL", "300"))
+# Diagnoses are reused for identical (signature, context) pairs for this many days
+DIAGNOSIS_CACHE_TTL_DAYS = int(os.getenv("DIAGNOSIS_CACHE_TTL_DAYS", "7"))
+# Agent step logging (DIAGNOSIS_VERBOSE=1 or VERBOSE_AGENT=1) is off by default; when on, tool events are also written to AGENT_EVENTS_INDEX
+_VERBOSE = "1" in (os.getenv("DIAGNOSIS_VERBOSE"), os.getenv("VERBOSE_AGENT"))
+AGENT_EVENTS_INDEX = "pega-agent-events"
+
+# Connection settings are fixed for the life of the process, so read them once
+_OPENSEARCH_URL = os.environ.get("OPENSEARCH_URL")
+_OPENSEARCH_USER = os.environ.get("OPENSEARCH_USER")
+_OPENSEARCH_PASS = os.environ.get("OPENSEARCH_PASS")
+_CLIENT_TIMEOUT = int(os.environ.get("CLIENT_TIMEOUT", 60))
+# Size the HTTP pool so concurrent diagnoses don't open a fresh TLS connection per request
+_POOL_MAXSIZE = int(os.environ.get("OPENSEARCH_POOL_MAXSIZE", max(32, 2 * DIAGNOSE_CONCURRENCY)))
+
+_MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "http://localhost:9900")
+_MCP_SERVER_CONFIG = {
+    "opensearch": { 
+        "url": _MCP_SERVER_URL,
+        "transport": "sse",
+        "headers": {
+            "Content-Type": "application/json",
+            "Accept-Encoding": "identity",
+        }
+    }
+}
+
 DEFAULT_PROMPT_TEMPLATE = '''You are a Senior Pega Lead System Architect (LSA) and low-level Pega engine expert specializing in clipboard internals, activity execution, data transforms, and JSON/page conversion functions.
 
 I will provide error-group data, rule definitions, activities, data transforms, Java steps, and logs from a Pega system.
@@ -117,64 +165,142 @@ PREVENTION
 (optional guardrails to prevent recurrence)
 "Assume you have full knowledge of Pega clipboard internals, activity execution engine, and JSON conversion functions. Your answer must identify the exact failing function and property."'''
 
+# The default template has a single placeholder; split it once so prompts are built by concatenation
+_PROMPT_PREFIX, _PROMPT_SUFFIX = DEFAULT_PROMPT_TEMPLATE.split("{context_str}", 1)
+
+# Tool-use guidance for the diagnosis agent; sent as the system message with custom templates
+_AGENT_INSTRUCTIONS = "You are a Pega diagnostics assistant. Use the OpenSearch tools only when the provided data is not enough to pinpoint the failure."
+# The default template minus its data section. Sent as the system message so every group shares
+# the same long prompt prefix, which OpenAI's automatic prompt caching can reuse.
+_SYSTEM_RUBRIC = (
+    _PROMPT_PREFIX.rsplit("DATA PROVIDED:", 1)[0].rstrip()
+    + "\n\n" + _PROMPT_SUFFIX.strip()
+    + "\n\n" + _AGENT_INSTRUCTIONS
+)
+
+def build_diagnosis_inputs(context_str, prompt_template=None):
+    """
+    Builds the agent inputs for diagnosing a group from its serialized context.
+    With the default template the static rubric goes in the system message and only the data in the human message.
+    A user supplied template gets the context at its {context_str} placeholder, or appended if it has none.
+    """
+    if not prompt_template or prompt_template == DEFAULT_PROMPT_TEMPLATE:
+        return {"instructions": _SYSTEM_RUBRIC, "input": f"DATA PROVIDED:\n{context_str}"}
+    if "{context_str}" in prompt_template:
+        # Plain substitution, so other braces in a user template don't break str.format
+        prompt = prompt_template.replace("{context_str}", context_str)
+    else:
+        prompt = f"{prompt_template}\n\nData Provided:\n{context_str}"
+    return {"instructions": _AGENT_INSTRUCTIONS, "input": prompt}
+
+# Markdown stripping rules, compiled once at import and applied in order by clean_markdown.
+# Each rule carries the marker character it needs, so passes that cannot match are skipped.
+_MD_PATTERNS = [
+    ('`', re.compile(r'```[a-zA-Z]*\n?|`'), ''),        # code block markers and inline backticks
+    ('*', re.compile(r'\*\*([^*]+)\*\*'), r'\1'),        # **bold**
+    ('*', re.compile(r'\*([^*]+)\*'), r'\1'),            # *italic*
+    ('_', re.compile(r'__([^_]+)__'), r'\1'),            # __bold__
+    ('_', re.compile(r'_([^_]+)_'), r'\1'),              # _italic_
+    ('#', re.compile(r'^#+\s*', re.MULTILINE), ''),      # ### Header
+]
+
 def clean_markdown(text):
     """
     Strips markdown formatting to return clean plain text.
     Removes: **bold**, ## Headers, `code`, and ```blocks```.
     """
-    # Remove code block markers
-    text = re.sub(r'```[a-zA-Z]*\n?', '', text)
-    text = re.sub(r'```', '', text)
-    
-    # Remove inline code backticks
-    text = re.sub(r'`', '', text)
-    
-    # Remove bold/italic markers (* or _)
-    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)  # **bold**
-    text = re.sub(r'\*([^*]+)\*', r'\1', text)      # *italic*
-    text = re.sub(r'__([^_]+)__', r'\1', text)      # __bold__
-    text = re.sub(r'_([^_]+)_', r'\1', text)        # _italic_
-    
-    # Remove headers (### Header)
-    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
+    for marker, pattern, repl in _MD_PATTERNS:
+        # Rules only ever delete characters, so a marker missing now can't appear later
+        if marker in text:
+            text = pattern.sub(repl, text)
     
     return text.strip()
 
-def get_opensearch_client():
-    OPENSEARCH_URL = os.environ.get("OPENSEARCH_URL")
-    OPENSEARCH_USER = os.environ.get("OPENSEARCH_USER")
-    OPENSEARCH_PASS = os.environ.get("OPENSEARCH_PASS")
-    CLIENT_TIMEOUT = int(os.environ.get("CLIENT_TIMEOUT", 60))
-
-    if not OPENSEARCH_URL or not OPENSEARCH_USER or not OPENSEARCH_PASS:
+def _build_opensearch_client(max_retries, retry_on_timeout):
+    if not _OPENSEARCH_URL or not _OPENSEARCH_USER or not _OPENSEARCH_PASS:
         raise ValueError("Missing required OpenSearch environment variables: OPENSEARCH_URL, OPENSEARCH_USER, OPENSEARCH_PASS")
 
     client = OpenSearch(
-        hosts=[OPENSEARCH_URL],
-        http_auth=(OPENSEARCH_USER, OPENSEARCH_PASS),
+        hosts=[_OPENSEARCH_URL],
+        http_auth=(_OPENSEARCH_USER, _OPENSEARCH_PASS),
+        connection_class=RequestsHttpConnection,
+        pool_maxsize=_POOL_MAXSIZE,
+        serializer=OrjsonSerializer(),
         verify_certs=False,
         ssl_show_warn=False,
-        timeout=CLIENT_TIMEOUT,
-        max_retries=5,
-        retry_on_timeout=True,
+        timeout=_CLIENT_TIMEOUT,
+        max_retries=max_retries,
+        retry_on_timeout=retry_on_timeout,
         retry_on_status=(500, 502, 503, 504)
     )
     return client
 
+@functools.lru_cache(maxsize=1)
+def get_opensearch_client():
+    """
+    Client for reads (search/get): retried aggressively since reads are idempotent and cheap.
+    Cached so every caller shares one connection pool.
+    """
+    return _build_opensearch_client(max_retries=5, retry_on_timeout=True)
+
+@functools.lru_cache(maxsize=1)
+def get_opensearch_write_client():
+    """
+    Client for the batch write path: few transport retries and none on timeout,
+    so a flapping cluster can't stall the workflow for max_retries * CLIENT_TIMEOUT.
+    Bulk writes do their own backoff on 429s in _flush_updates.
+    """
+    return _build_opensearch_client(max_retries=2, retry_on_timeout=False)
+
+# (client id, index) pairs already confirmed to exist
+_INDEX_EXISTS_CACHE = set()
+
+# Larger fetch_grouped_errors requests are paged with PIT + search_after instead of one deep from/size search
+_GROUP_PAGE_SIZE = 500
+
+def _search_after_pages(client, index, query, size, keep_alive="1m"):
+    """
+    Collects up to size hits for query by paging a Point-In-Time snapshot with search_after.
+    query must have a deterministic sort (ending in a unique tiebreaker).
+    """
+    pit_id = client.create_point_in_time(index=index, keep_alive=keep_alive)["pit_id"]
+    hits = []
+    try:
+        body = dict(query, pit={"id": pit_id, "keep_alive": keep_alive})
+        while len(hits) < size:
+            body["size"] = min(_GROUP_PAGE_SIZE, size - len(hits))
+            page = client.search(body=body)['hits']['hits']
+            hits.extend(page)
+            if len(page) < body["size"]:
+                break
+            body["search_after"] = page[-1]["sort"]
+    finally:
+        try:
+            client.delete_point_in_time(body={"pit_id": [pit_id]})
+        except Exception as e:
+            print(f"Failed to close point in time: {e}")
+    return hits
+
 def fetch_grouped_errors(client, size=5):
     """
     Fetch top grouped errors from pega-analysis-results.
     Prioritizes groups with 'PENDING' diagnosis or just largest counts.
+    Returns lightweight summaries only; the full group document is fetched when it is diagnosed.
     """
     index = "pega-analysis-results"
     
-    # Check if index exists first
-    if not client.indices.exists(index=index):
-        print(f"Index {index} does not exist. Run log_grouper.py first.")
-        return []
+    # Check if index exists first (once per client/index; an index is never dropped mid-run)
+    if (id(client), index) not in _INDEX_EXISTS_CACHE:
+        if not client.indices.exists(index=index):
+            print(f"Index {index} does not exist. Run log_grouper.py first.")
+            return []
+        _INDEX_EXISTS_CACHE.add((id(client), index))
 
     query = {
-        "size": size,
+        "size": min(size, _GROUP_PAGE_SIZE),
+        "_source": {"includes": ["group_signature", "count", "diagnosis.status"]},
+        # Only the top hits are used, so skip counting every pending group
+        "track_total_hits": False,
         "query": {
             "bool": {
                 "must": [
@@ -182,13 +308,18 @@ def fetch_grouped_errors(client, size=5):
                 ]
             }
         },
+        # _id tiebreaker keeps the order (and search_after paging) deterministic for equal counts
         "sort": [
-            {"count": {"order": "desc"}}
+            {"count": {"order": "desc"}},
+            {"_id": {"order": "asc"}}
         ]
     }
     
-    response = client.search(body=query, index=index)
-    hits = response['hits']['hits']
+    if size <= _GROUP_PAGE_SIZE:
+        response = client.search(body=query, index=index)
+        hits = response['hits']['hits']
+    else:
+        hits = _search_after_pages(client, index, query, size)
     
     results = []
     for hit in hits:
@@ -200,120 +331,571 @@ def fetch_grouped_errors(client, size=5):
 
 
 
-def update_diagnosis_in_opensearch(client, doc_id, diagnosis_text, token_usage=None):
+# Flush a workflow run's buffered updates early once it reaches this many
+_FLUSH_EVERY = 50
+
+def _utc_now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+def _diagnosis_update_doc(diagnosis_text, token_usage=None, timestamp=None):
+    """
+    Build the partial document written back to a group once it has been diagnosed.
+    """
+    return {
+        "diagnosis": {
+            "status": "DIAGNOSIS COMPLETED",
+            "report": diagnosis_text,
+            "timestamp": timestamp or _utc_now_iso(),
+            "token_usage": token_usage or {}
+        }
+    }
+
+def update_diagnosis_in_opensearch(client, doc_id, diagnosis_text, token_usage=None, pending=None, refresh=None):
     """
     Update the grouped document with diagnosis results.
+    Given a pending list, the update is queued there as (doc_id, diagnosis_text, token_usage)
+    and written later by _flush_updates.
+    refresh="wait_for" returns only once the change is visible to searches.
     """
+    if pending is not None:
+        pending.append((doc_id, diagnosis_text, token_usage))
+        return
+
     index = "pega-analysis-results"
     
-    body = {
-        "doc": {
-            "diagnosis": {
-                "status": "DIAGNOSIS COMPLETED",
-                "report": diagnosis_text,
-                "report": diagnosis_text,
-                "timestamp": datetime.utcnow().isoformat(),
-                "token_usage": token_usage or {}
-            }
-        }
-    }
+    body = {"doc": _diagnosis_update_doc(diagnosis_text, token_usage)}
     
     try:
-        client.update(index=index, id=doc_id, body=body)
+        kwargs = {"refresh": refresh} if refresh else {}
+        client.update(index=index, id=doc_id, body=body, **kwargs)
         print(f"Updated diagnosis for group {doc_id}")
     except Exception as e:
         print(f"Failed to update diagnosis for {doc_id}: {e}")
 
+# Failed diagnosis writes are recorded here instead of aborting the batch
+DIAGNOSIS_ERRORS_INDEX = "pega-diagnosis-errors"
+
+def _log_write_errors(client, errors, timestamp):
+    """
+    Best-effort record of failed bulk items in DIAGNOSIS_ERRORS_INDEX.
+    """
+    actions = []
+    for item in errors:
+        op = next(iter(item.values()), {})
+        actions.append({
+            "_index": DIAGNOSIS_ERRORS_INDEX,
+            "_source": {
+                "timestamp": timestamp,
+                "stage": "diagnosis_update",
+                "doc_id": op.get("_id"),
+                "status": op.get("status"),
+                "error": str(op.get("error") or op.get("exception") or item)
+            }
+        })
+
+    try:
+        helpers.bulk(client, actions, raise_on_error=False, raise_on_exception=False)
+    except Exception as e:
+        print(f"Failed to record diagnosis write errors: {e}")
+
+def _flush_updates(client, updates, log=print):
+    """
+    Write queued diagnosis updates in a single bulk request and return the ids that were saved.
+    Errors are logged to DIAGNOSIS_ERRORS_INDEX rather than raised so one bad group doesn't abort the batch.
+    Blocking (bulk backs off on 429s), so the workflow calls it through asyncio.to_thread.
+    """
+    if not updates:
+        return set()
+
+    # One timestamp for the whole batch
+    now_iso = _utc_now_iso()
+    actions = [
+        {
+            "_op_type": "update",
+            "_index": "pega-analysis-results",
+            "_id": doc_id,
+            "doc": _diagnosis_update_doc(diagnosis_text, token_usage, timestamp=now_iso)
+        }
+        for doc_id, diagnosis_text, token_usage in updates
+    ]
+
+    try:
+        # Retries with exponential backoff apply to 429 (rejected) items only
+        success, errors = helpers.bulk(
+            client, actions,
+            raise_on_error=False, raise_on_exception=False,
+            max_retries=3, initial_backoff=1, max_backoff=8
+        )
+        log(f"Flushed {success} diagnosis updates ({len(errors)} failed)")
+        failed_ids = [next(iter(item.values()), {}).get("_id") for item in errors]
+        if errors:
+            log(f"Failed diagnosis updates: {failed_ids}")
+            _log_write_errors(client, errors, now_iso)
+        return {doc_id for doc_id, _, _ in updates} - set(failed_ids)
+    except Exception as e:
+        log(f"Failed to flush diagnosis updates: {e}")
+        return set()
+
+async def _flush_pending(client, pending, written, log=print):
+    """
+    Hand a workflow run's queued updates to _flush_updates off the event loop; saved ids are added to written.
+    """
+    # Take the batch before awaiting so updates queued meanwhile wait for the next flush
+    batch = pending[:]
+    pending.clear()
+    written.update(await asyncio.to_thread(_flush_updates, client, batch, log))
+
+
+
+# Previously generated diagnoses, keyed by _diagnosis_cache_key
+DIAGNOSIS_CACHE_INDEX = "pega-diagnosis-cache"
+
+def _stable_hash(obj):
+    """
+    Hash that doesn't depend on dict key order.
+    """
+    return hashlib.sha256(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _diagnosis_cache_key(group_signature, context):
+    return hashlib.sha256((str(group_signature or "") + _stable_hash(context)).encode()).hexdigest()
+
+def _get_cached_diagnosis(client, key):
+    """
+    Returns (diagnosis_text, token_usage) for a cache hit younger than DIAGNOSIS_CACHE_TTL_DAYS, else None.
+    """
+    try:
+        resp = client.get(index=DIAGNOSIS_CACHE_INDEX, id=key, ignore=404)
+    except Exception as e:
+        print(f"Diagnosis cache lookup failed: {e}")
+        return None
+
+    if not resp.get("found"):
+        return None
+
+    source = resp.get("_source", {})
+    try:
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(source["ts"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if age > timedelta(days=DIAGNOSIS_CACHE_TTL_DAYS) or not source.get("text"):
+        return None
+
+    return source["text"], source.get("usage") or {}
+
+def _put_cached_diagnosis(client, key, diagnosis_text, token_usage):
+    try:
+        client.index(
+            index=DIAGNOSIS_CACHE_INDEX,
+            id=key,
+            body={"text": diagnosis_text, "usage": token_usage or {}, "ts": _utc_now_iso()}
+        )
+    except Exception as e:
+        print(f"Failed to store diagnosis in cache: {e}")
+
+_TRUNCATION_MARKER = "...[truncated]"
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    """
+    GPT-4o tokenizer, loaded on first use (tiktoken may need to download the encoding file).
+    Returns None if it can't be loaded (e.g. offline); the result is cached either way,
+    so a missing encoding is tried once per process rather than on every context build.
+    """
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        print(f"Tokenizer unavailable, context truncation disabled: {e}")
+        return None
+
+def _count_tokens(value):
+    return len(_get_encoder().encode(orjson.dumps(value).decode()))
 
+def _truncate_context(ctx, max_tokens=CONTEXT_MAX_TOKENS):
+    """
+    Trims the largest string/list fields of the context until its JSON form fits in max_tokens.
+    Strings lose their tail (a marker is appended), lists lose their last items.
+    Each field is tokenized once up front; after that only the field just trimmed is re-counted.
+    Returns: (ctx, tokens_before, tokens_after)
+    """
+    enc = _get_encoder()
+    total = before = _count_tokens(ctx)
+    if total <= max_tokens:
+        return ctx, before, total
+
+    sizes = {k: _count_tokens(v) for k, v in ctx.items() if isinstance(v, (str, list)) and v}
+    marker_tokens = len(enc.encode(_TRUNCATION_MARKER))
+
+    # Bounded so a pathological document can never spin forever
+    for _ in range(20):
+        if total <= max_tokens or not sizes:
+            break
+
+        key = max(sizes, key=sizes.get)
+        value = ctx[key]
+        overshoot = total - max_tokens
+
+        if isinstance(value, str):
+            if value.endswith(_TRUNCATION_MARKER):
+                value = value[:-len(_TRUNCATION_MARKER)]
+            tokens = enc.encode(value)
+            keep = len(tokens) - overshoot - marker_tokens
+            ctx[key] = enc.decode(tokens[:keep]) + _TRUNCATION_MARKER if keep > 0 else ""
+        else:
+            keep_ratio = max(0.0, (sizes[key] - overshoot) / sizes[key])
+            ctx[key] = value[:min(int(len(value) * keep_ratio), len(value) - 1)]
+
+        # Only this field changed, so adjust the running total by its new size
+        new_size = _count_tokens(ctx[key])
+        total += new_size - sizes[key]
+        if ctx[key]:
+            sizes[key] = new_size
+        else:
+            del sizes[key]
+
+    # Exact count of the result (per-field counts ignore token merges across JSON punctuation)
+    return ctx, before, _count_tokens(ctx)
+
+def _cap_context_fields(ctx):
+    """
+    Bounds the fields that can be arbitrarily large on a noisy group:
+    representative_log text to DIAG_LOG_CHARS and the signature lists to DIAG_SIG_TOPK entries.
+    """
+    rep_log = ctx.get('representative_log')
+    if isinstance(rep_log, str):
+        ctx['representative_log'] = rep_log[:DIAG_LOG_CHARS]
+    elif isinstance(rep_log, dict):
+        ctx['representative_log'] = {
+            k: v[:DIAG_LOG_CHARS] if isinstance(v, str) else v
+            for k, v in rep_log.items()
+        }
 
-def construct_analysis_context(group_doc, pega_api_response=None):
+    for key in ('exception_signatures', 'message_signatures'):
+        if isinstance(ctx.get(key), list):
+            ctx[key] = ctx[key][:DIAG_SIG_TOPK]
+
+    return ctx
+
+def construct_analysis_context(group_doc, pega_api_response=None, stats=None):
     """
     Helper to construct the analysis context dictionary from a group document.
-    Returns the full group document to ensure all fields (including rules) are available to the LLM.
+    Returns the full group document to ensure all fields (including rules) are available to the LLM,
+    trimmed to CONTEXT_MAX_TOKENS so oversized groups don't blow up prompt cost and latency.
     Optionally includes Pega API response if available.
+    If a stats dict is passed, it receives the context token counts before/after trimming.
     """
-    context = group_doc.copy()
+    context = _cap_context_fields(group_doc.copy())
     
     if pega_api_response:
         context['pega_api_insights'] = pega_api_response
+
+    if _get_encoder() is None:
+        # Tokenizer unavailable (e.g. offline with no cached encoding) - send the context untrimmed
+        return context
+
+    try:
+        context, tokens_before, tokens_after = _truncate_context(context)
+        if stats is not None:
+            stats["context_tokens_before"] = tokens_before
+            stats["context_tokens_after"] = tokens_after
+    except Exception as e:
+        print(f"Skipping context truncation: {e}")
     
     return context
 
-async def execute_diagnosis(agent, prompt):
+def _read_tools_cache():
+    try:
+        with open(MCP_TOOLS_CACHE_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_tools_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(MCP_TOOLS_CACHE_PATH), exist_ok=True)
+        tmp_path = f"{MCP_TOOLS_CACHE_PATH}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, MCP_TOOLS_CACHE_PATH)
+    except OSError as e:
+        print(f"Could not write MCP tools cache: {e}")
+
+async def _load_tools(mcp_client, connection):
+    """
+    Returns LangChain tools for the MCP server, using the on-disk schema cache when it is fresh.
+    Cached schemas are turned back into tools that open their own MCP session per call,
+    exactly like the tools returned by get_tools().
+    """
+    url = connection["url"]
+    entry = _read_tools_cache().get(url)
+
+    if entry and time.time() - entry.get("fetched_at", 0) < MCP_TOOLS_CACHE_TTL:
+        try:
+            return [
+                convert_mcp_tool_to_langchain_tool(None, MCPTool.model_validate(spec), connection=connection)
+                for spec in entry["tools"]
+            ]
+        except Exception as e:
+            print(f"Ignoring unreadable MCP tools cache: {e}")
+
+    try:
+        tools = await mcp_client.get_tools()
+    except Exception:
+        # Handshake failed - don't let a stale schema outlive an unreachable/changed server
+        cache = _read_tools_cache()
+        if cache.pop(url, None) is not None:
+            _write_tools_cache(cache)
+        raise
+
+    specs = [
+        {
+            "name": t.name,
+            "description": t.description,
+            "inputSchema": t.args_schema if isinstance(t.args_schema, dict) else t.args_schema.model_json_schema(),
+        }
+        for t in tools
+    ]
+    cache = _read_tools_cache()
+    cache[url] = {"fetched_at": time.time(), "tools": specs}
+    _write_tools_cache(cache)
+
+    return tools
+
+class AsyncOpenSearchCallbackHandler(AsyncCallbackHandler):
+    """
+    Records agent tool calls in OpenSearch.
+    Events are buffered and bulk-written from a worker thread so logging never blocks the event loop.
+    """
+
+    def __init__(self, client, index=AGENT_EVENTS_INDEX, max_output_chars=2000):
+        self.client = client
+        self.index = index
+        self.max_output_chars = max_output_chars
+        self._events = []
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        self._add("tool_start", run_id, parent_run_id, tool=(serialized or {}).get("name"), input=input_str)
+
+    async def on_tool_end(self, output, *, run_id, parent_run_id=None, **kwargs):
+        self._add("tool_end", run_id, parent_run_id, output=str(output)[:self.max_output_chars])
+        await self.flush()
+
+    async def on_tool_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self._add("tool_error", run_id, parent_run_id, error=str(error))
+        await self.flush()
+
+    def _add(self, event, run_id, parent_run_id, **fields):
+        self._events.append({
+            "event": event,
+            "run_id": str(run_id),
+            "parent_run_id": str(parent_run_id) if parent_run_id else None,
+            "timestamp": _utc_now_iso(),
+            **fields
+        })
+
+    async def flush(self):
+        if not self._events:
+            return
+        actions = [{"_index": self.index, "_source": event} for event in self._events]
+        self._events = []
+        try:
+            await asyncio.to_thread(helpers.bulk, self.client, actions, raise_on_error=False, raise_on_exception=False)
+        except Exception as e:
+            print(f"Failed to write agent events: {e}")
+
+def agent_event_callbacks():
+    """
+    Callbacks to attach to agent tools: an OpenSearch event logger when DIAGNOSIS_VERBOSE=1, otherwise none.
+    """
+    if not _VERBOSE:
+        return []
+    return [AsyncOpenSearchCallbackHandler(get_opensearch_write_client())]
+
+# One ChatOpenAI per event loop, so its HTTP connection pool stays warm across diagnoses and chats
+_LLM_CACHE = weakref.WeakKeyDictionary()
+
+def get_llm():
+    """
+    Returns the shared streaming gpt-4o client for the running event loop.
+    The client's async HTTP pool is bound to the loop that first used it, hence one instance per loop.
+    """
+    loop = asyncio.get_running_loop()
+    llm = _LLM_CACHE.get(loop)
+    if llm is None:
+        llm = ChatOpenAI(model="gpt-4o", streaming=True, stream_usage=True)
+        _LLM_CACHE[loop] = llm
+    return llm
+
+# Process-wide agent cache (MCP tool discovery + LLM wrapper are built once and reused)
+_AGENT_CACHE = {}
+# Guards only the agent (re)build, one lock per event loop (an asyncio.Lock is bound to a single loop)
+_AGENT_BUILD_LOCKS = weakref.WeakKeyDictionary()
+
+def _cached_agent(loop):
+    """The cached agent if it was built on this loop and is younger than AGENT_CACHE_TTL, else None."""
+    if _AGENT_CACHE.get("loop") is not loop or time.monotonic() - _AGENT_CACHE.get("ts", 0) > AGENT_CACHE_TTL:
+        return None
+    return _AGENT_CACHE.get("agent")
+
+async def _get_agent():
+    """
+    Returns the shared diagnosis agent, building it on first use.
+    The agent is rebuilt if called from a different event loop, since its HTTP clients are bound to the loop that created them,
+    or once it is older than AGENT_CACHE_TTL.
+    A fresh agent is returned without locking, so concurrent sessions never queue behind each other;
+    only a rebuild takes the lock, so it happens once.
+    """
+    loop = asyncio.get_running_loop()
+    agent = _cached_agent(loop)
+    if agent is not None:
+        return agent
+
+    lock = _AGENT_BUILD_LOCKS.setdefault(loop, asyncio.Lock())
+    async with lock:
+        if _cached_agent(loop) is None:
+            mcp_client = MultiServerMCPClient(_MCP_SERVER_CONFIG)
+            tools = await _load_tools(mcp_client, _MCP_SERVER_CONFIG["opensearch"])
+            print(f"Loaded {len(tools)} tools from MCP server")
+            # Tool-level callbacks fire however the executor is invoked
+            callbacks = agent_event_callbacks()
+            for mcp_tool in tools:
+                mcp_tool.callbacks = callbacks or None
+
+            llm = get_llm()
+
+            prompt = ChatPromptTemplate.from_messages([
+                ("system", "{instructions}"),
+                ("human", "{input}"),
+                MessagesPlaceholder(variable_name="agent_scratchpad"),
+            ])
+
+            agent = AgentExecutor(
+                agent=create_tool_calling_agent(llm, tools, prompt),
+                tools=tools,
+                verbose=_VERBOSE,
+                handle_parsing_errors=True
+            )
+
+            _AGENT_CACHE.update({"mcp_client": mcp_client, "agent": agent, "loop": loop, "ts": time.monotonic()})
+
+        return _AGENT_CACHE["agent"]
+
+async def close_agent():
+    """
+    Drops the cached agent and MCP client (call on shutdown).
+    MultiServerMCPClient opens an SSE session per tool call, so there is no persistent connection to close.
+    """
+    _AGENT_CACHE.clear()
+
+# GPT-4o list price in USD per token (prompt tokens served from OpenAI's prompt cache are billed at cached_input)
+_GPT4O_PRICING = {"input": 0.0025e-3, "cached_input": 0.00125e-3, "output": 0.01e-3}
+
+def _new_token_usage():
+    """
+    Empty token_usage dict in the shape stored in OpenSearch.
+    """
+    return {"total_tokens": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0, "total_cost": 0.0}
+
+def _add_usage_metadata(token_usage, usage_metadata):
+    """
+    Accumulates an AIMessage.usage_metadata dict (populated from OpenAI's native usage field) into token_usage.
+    """
+    input_tokens = usage_metadata.get("input_tokens", 0)
+    output_tokens = usage_metadata.get("output_tokens", 0)
+    cached_tokens = (usage_metadata.get("input_token_details") or {}).get("cache_read", 0) or 0
+    token_usage["prompt_tokens"] += input_tokens
+    token_usage["cached_prompt_tokens"] += cached_tokens
+    token_usage["completion_tokens"] += output_tokens
+    token_usage["total_tokens"] += usage_metadata.get("total_tokens", input_tokens + output_tokens)
+    token_usage["total_cost"] += (
+        (input_tokens - cached_tokens) * _GPT4O_PRICING["input"]
+        + cached_tokens * _GPT4O_PRICING["cached_input"]
+        + output_tokens * _GPT4O_PRICING["output"]
+    )
+
+async def execute_diagnosis_stream(agent, inputs, token_usage=None):
+    """
+    Streams the diagnosis from the agent as the LLM generates it.
+    inputs is a dict from build_diagnosis_inputs, or a plain prompt string.
+    Yields raw text deltas (markdown is not stripped here).
+    If token_usage is given, usage from every LLM call in the agent run is added to it.
+    """
+    if isinstance(inputs, str):
+        inputs = {"instructions": _AGENT_INSTRUCTIONS, "input": inputs}
+    async for event in agent.astream_events(inputs, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream":
+            delta = event["data"]["chunk"].content
+            if delta:
+                yield delta
+        elif kind == "on_chat_model_end" and token_usage is not None:
+            usage_metadata = getattr(event["data"].get("output"), "usage_metadata", None)
+            if usage_metadata:
+                _add_usage_metadata(token_usage, usage_metadata)
+
+async def execute_diagnosis(agent, inputs):
     """
-    Executes the diagnosis using the provided agent and prompt.
+    Executes the diagnosis using the provided agent and inputs (see execute_diagnosis_stream).
     Returns: (diagnosis_text, token_usage)
     """
     try:
-        with get_openai_callback() as cb:
-            response = await agent.ainvoke({"input": prompt})
-            raw_text = response["output"]
-            diagnosis_text = clean_markdown(raw_text)
-            
-            token_usage = {
-                "total_tokens": cb.total_tokens,
-                "prompt_tokens": cb.prompt_tokens,
-                "completion_tokens": cb.completion_tokens,
-                "total_cost": cb.total_cost
-            }
-            print(f"  Diagnosis Cost: ${cb.total_cost:.4f} (Tokens: {cb.total_tokens})")
-            return diagnosis_text, token_usage
+        token_usage = _new_token_usage()
+        parts = []
+        async for delta in execute_diagnosis_stream(agent, inputs, token_usage):
+            parts.append(delta)
+        diagnosis_text = clean_markdown("".join(parts))
+        
+        print(f"  Diagnosis Cost: ${token_usage['total_cost']:.4f} (Tokens: {token_usage['total_tokens']})")
+        return diagnosis_text, token_usage
     except Exception as exc:
         print(f"Failed to execute diagnosis: {exc}")
         return None, None
 
-async def diagnose_single_group(client, group_id, prompt_template=None, pega_api_response=None):
+async def _prepare_group_diagnosis(client, group_id, prompt_template=None, pega_api_response=None, group_source=None):
+    """
+    Builds the agent and inputs used to diagnose a group.
+    The group is fetched by ID unless the caller already has its _source (group_source).
+    Returns: (agent, inputs, context_stats), or (None, None, None) if the group does not exist.
+    """
+    # 1. Fetch Group Data (skipped when the caller passes it in)
+    if group_source is not None:
+        source = group_source
+    else:
+        # Blocking reads and tokenization run off the event loop, which the dashboard shares across sessions
+        group_doc = await asyncio.to_thread(client.get, index="pega-analysis-results", id=group_id)
+        if not group_doc or '_source' not in group_doc:
+            return None, None, None
+        source = group_doc['_source']
+    context_stats = {}
+    analysis_context = await asyncio.to_thread(construct_analysis_context, source, pega_api_response, stats=context_stats)
+    context_str = orjson.dumps(analysis_context).decode()
+
+    # 2. Get shared Agent
+    agent = await _get_agent()
+
+    # 3. Construct Prompt
+    inputs = build_diagnosis_inputs(context_str, prompt_template)
+
+    return agent, inputs, context_stats
+
+async def diagnose_single_group(client, group_id, prompt_template=None, pega_api_response=None, group_source=None):
     """
     Standalone function to diagnose a single group by ID.
     Used by the Dashboard for on-demand analysis.
+    Pass group_source (the group's _source) if already loaded to skip re-fetching it.
     """
     try:
-        # 1. Fetch Group Data
-        group_doc = client.get(index="pega-analysis-results", id=group_id)
-        if not group_doc or '_source' not in group_doc:
+        agent, inputs, context_stats = await _prepare_group_diagnosis(client, group_id, prompt_template, pega_api_response, group_source)
+        if agent is None:
              return "Group not found or deleted.", {}
-        
-        source = group_doc['_source']
-        analysis_context = construct_analysis_context(source, pega_api_response)
-        context_str = json.dumps(analysis_context, indent=2)
-
-        # 2. Setup Agent (Re-using logic from main flow, could be optimized to pass agent in)
-        mcp_server_config = {
-            "opensearch": { 
-                "url": os.getenv("MCP_SERVER_URL", "http://localhost:9900"),
-                "transport": "sse",
-                "headers": {"Content-Type": "application/json", "Accept-Encoding": "identity"}
-            }
-        }
-        
-        mcp_client = MultiServerMCPClient(mcp_server_config)
-        tools = await mcp_client.get_tools()
-        llm = ChatOpenAI(model="gpt-4o")
-        agent = initialize_agent(
-            tools=tools,
-            llm=llm,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            verbose=True,
-            handle_parsing_errors=True
-        )
-
-        # 3. Construct Prompt
-        if not prompt_template:
-            # Default Prompt
-            prompt = DEFAULT_PROMPT_TEMPLATE.format(context_str=context_str)
-        else:
-            # Inject context into user provided template if placeholder exists, else append
-            if "{context_str}" in prompt_template:
-                prompt = prompt_template.format(context_str=context_str)
-            else:
-                prompt = f"{prompt_template}\n\nData Provided:\n{context_str}"
 
         # 4. Execute
-        diagnosis_text, token_usage = await execute_diagnosis(agent, prompt)
+        diagnosis_text, token_usage = await execute_diagnosis(agent, inputs)
+        if token_usage:
+            token_usage.update(context_stats)
         
         # 5. Update OpenSearch
         if diagnosis_text:
-             update_diagnosis_in_opensearch(client, group_id, diagnosis_text, token_usage)
+             await asyncio.to_thread(update_diagnosis_in_opensearch, client, group_id, diagnosis_text, token_usage)
              
         return diagnosis_text, token_usage
 
@@ -321,78 +903,141 @@ async def diagnose_single_group(client, group_id, prompt_template=None, pega_api
         print(f"Error in diagnose_single_group: {e}")
         return f"Error: {str(e)}", {}
 
-
-
-async def run_diagnosis_workflow():
-    print("Starting Log Diagnosis Workflow (LangChain)")
-    client = get_opensearch_client()
-    
-    # 1. Fetch Grouped Errors
-    grouped_errors = fetch_grouped_errors(client)
-    print(f"Found {len(grouped_errors)} pending error groups to diagnose")
-    
-    if not grouped_errors:
-        print("No pending error groups found. Make sure log_grouper.py has run.")
+async def stream_diagnosis(client, group_id, prompt_template=None, pega_api_response=None, group_source=None):
+    """
+    Streaming variant of diagnose_single_group.
+    Yields text deltas as they arrive; the cleaned report is saved to OpenSearch once the stream ends.
+    """
+    agent, inputs, context_stats = await _prepare_group_diagnosis(client, group_id, prompt_template, pega_api_response, group_source)
+    if agent is None:
+        yield "Group not found or deleted."
         return
 
-    # 2. Define MCP Server URL
-    mcp_server_config = {
-        "opensearch": { 
-            "url": os.getenv("MCP_SERVER_URL", "http://localhost:9900"),
-            "transport": "sse",
-            "headers": {
-                "Content-Type": "application/json",
-                "Accept-Encoding": "identity",
-            }
-        }
-    }
-    
-    try:
-        mcp_client = MultiServerMCPClient(mcp_server_config)
-        tools = await mcp_client.get_tools() 
-        print(f"Fetched {len(tools)} tools from MCP server")
+    token_usage = _new_token_usage()
+    parts = []
+    async for delta in execute_diagnosis_stream(agent, inputs, token_usage):
+        parts.append(delta)
+        yield delta
 
+    diagnosis_text = clean_markdown("".join(parts))
+    if diagnosis_text:
+        token_usage.update(context_stats)
+        await asyncio.to_thread(update_diagnosis_in_opensearch, client, group_id, diagnosis_text, token_usage)
 
-        MODEL_NAME = "gpt-4o"
-        llm = ChatOpenAI(model=MODEL_NAME)
 
-        # 3. Initialize LangChain Agent
-        agent = initialize_agent(
-            tools=tools,
-            llm=llm,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            verbose=True,
-            handle_parsing_errors=True
-        )
 
-        # 4. Process each group
-        for group_doc in grouped_errors:
-            group_id = group_doc['_id']
-            
-            # Construct Context
-            analysis_context = construct_analysis_context(group_doc)
-            
-            context_str = json.dumps(analysis_context, indent=2)
-            
-            print(f"Diagnosing Group: {group_doc.get('group_signature')} (Count: {group_doc.get('count')})")
+async def _diagnose_one(group_doc, agent, client, sem, pending, written, write_client=None, log=print):
+    """
+    Diagnose a single group from the batch workflow.
+    The semaphore bounds how many LLM calls are in flight at once.
+    The result is queued on the run's pending list; ids whose bulk write succeeded end up in written.
+    Reads use client; queued writes are flushed with write_client (defaults to client).
+    """
+    group_id = group_doc['_id']
+    async with sem:
+        # Fetch the full group document off the event loop so it overlaps other groups' LLM calls
+        full_doc = await asyncio.to_thread(client.get, index="pega-analysis-results", id=group_id)
+        
+        # Construct Context
+        context_stats = {}
+        # Tokenizing/trimming the context is CPU work, so it runs off the event loop too
+        analysis_context = await asyncio.to_thread(construct_analysis_context, full_doc['_source'], stats=context_stats)
+        
+        context_str = orjson.dumps(analysis_context).decode()
+
+        # Reuse an earlier diagnosis of an identical group instead of calling the LLM again
+        cache_key = _diagnosis_cache_key(group_doc.get('group_signature'), analysis_context)
+        cached = await asyncio.to_thread(_get_cached_diagnosis, client, cache_key)
+        if cached:
+            diagnosis_text, token_usage = cached
+            log(f"Reusing cached diagnosis for group: {group_doc.get('group_signature')}")
+            token_usage = {**token_usage, **context_stats, "cache_hit": True}
+        else:
+            log(f"Diagnosing Group: {group_doc.get('group_signature')} (Count: {group_doc.get('count')})")
 
             # Define Prompt
-            prompt = DEFAULT_PROMPT_TEMPLATE.format(context_str=context_str)
+            inputs = build_diagnosis_inputs(context_str)
 
-            # Invoke Agent
-            diagnosis_text, token_usage = await execute_diagnosis(agent, prompt)
+            # Invoke Agent (token usage is accumulated per task inside execute_diagnosis)
+            diagnosis_text, token_usage = await execute_diagnosis(agent, inputs)
+            if token_usage:
+                token_usage.update(context_stats)
             
             if diagnosis_text:
-                update_diagnosis_in_opensearch(client, group_id, diagnosis_text, token_usage)
+                await asyncio.to_thread(_put_cached_diagnosis, write_client or client, cache_key, diagnosis_text, token_usage)
+
+    # Queue and flush outside the semaphore so a slow bulk write doesn't hold an LLM slot
+    if diagnosis_text:
+        update_diagnosis_in_opensearch(client, group_id, diagnosis_text, token_usage, pending=pending)
+        if len(pending) >= _FLUSH_EVERY:
+            await _flush_pending(write_client or client, pending, written, log)
+
+    return diagnosis_text, token_usage
+
+def _run_logger(lines):
+    """print() that also keeps each message in lines, so one workflow run's log can be returned to its caller."""
+    def log(message):
+        print(message)
+        lines.append(message)
+    return log
+
+async def run_diagnosis_workflow(client=None, write_client=None, top_n=5):
+    """
+    Diagnose the top_n pending error groups and persist the reports.
+    Callers that already hold an OpenSearch client (the dashboard) pass it in to reuse its pool.
+    Returns {"groups": found, "diagnosed": saved, "failed": [group ids], "log": [lines]}; only reports whose
+    write succeeded count as diagnosed. "log" holds this run's own progress messages (they are printed too),
+    so a caller can show them without capturing the process-wide stdout.
+    """
+    summary = {"groups": 0, "diagnosed": 0, "failed": [], "log": []}
+    log = _run_logger(summary["log"])
+    log("Starting Log Diagnosis Workflow (LangChain)")
+    client = client or get_opensearch_client()
+    write_client = write_client or get_opensearch_write_client()
+    
+    # 1. Fetch Grouped Errors
+    grouped_errors = await asyncio.to_thread(fetch_grouped_errors, client, size=top_n)
+    summary["groups"] = len(grouped_errors)
+    log(f"Found {len(grouped_errors)} pending error groups to diagnose")
+    
+    if not grouped_errors:
+        log("No pending error groups found. Make sure log_grouper.py has run.")
+        return summary
+
+    try:
+        # 2. Get shared LangChain Agent (MCP tools + LLM)
+        agent = await _get_agent()
+
+        # 3. Process groups concurrently (bounded to respect OpenAI rate limits)
+        sem = asyncio.Semaphore(DIAGNOSE_CONCURRENCY)
+        # Buffered updates and saved ids belong to this run, so concurrent runs never flush each other's work
+        pending, written = [], set()
+        tasks = [_diagnose_one(group_doc, agent, client, sem, pending, written, write_client, log) for group_doc in grouped_errors]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Persist the remaining diagnoses in one bulk round-trip
+        await _flush_pending(write_client, pending, written, log)
+
+        for group_doc, result in zip(grouped_errors, results):
+            if isinstance(result, Exception):
+                log(f"Diagnosis failed for group {group_doc['_id']}: {result}")
+                summary["failed"].append(group_doc['_id'])
+            elif result[0] and group_doc['_id'] in written:
+                summary["diagnosed"] += 1
+            elif result[0]:
+                summary["failed"].append(group_doc['_id'])
             
     except Exception as e:
-        print(f"Error in diagnosis workflow: {e}")
+        log(f"Error in diagnosis workflow: {e}")
         import traceback
         traceback.print_exc()
         # Handle TaskGroup exceptions explicitly if present
         if hasattr(e, 'exceptions'):
             for sub_exc in e.exceptions:
-                print(f"Sub-exception: {sub_exc}")
+                log(f"Sub-exception: {sub_exc}")
+        summary["error"] = str(e)
+
+    return summary
 
 if __name__ == "__main__":
     asyncio.run(run_diagnosis_workflow())
\ No newline at end of file
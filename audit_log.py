@@ -0,0 +1,100 @@
+"""
+Audit Log Module
+Flat pega-audit-log index (one doc per audit entry) shared by the Streamlit
+dashboard and the API server, so both create it with the same explicit mapping.
+Entries embedded in the groups' audit_history arrays before the index existed
+are copied in by backfill_audit_log.
+"""
+
+import hashlib
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from opensearchpy import helpers
+
+AUDIT_LOG_INDEX = "pega-audit-log"
+
+AUDIT_LOG_MAPPINGS = {
+    "properties": {
+        "timestamp": {"type": "date", "format": "strict_date_optional_time"},
+        "user": {"type": "keyword"},
+        "action": {"type": "keyword"},
+        "details": {"type": "text"},
+        "doc_id": {"type": "keyword"}
+    }
+}
+
+# Older audit entries were written as naive IST strings
+LEGACY_TIMEZONE = ZoneInfo("Asia/Kolkata")
+
+
+def ensure_audit_log_index(client):
+    """
+    Create AUDIT_LOG_INDEX with a date-typed timestamp so it sorts on the cluster.
+    A no-op when the index already exists; failures are logged, not raised.
+    """
+    try:
+        client.indices.create(index=AUDIT_LOG_INDEX, body={"mappings": AUDIT_LOG_MAPPINGS}, ignore=400)
+    except Exception as e:
+        print(f"Could not create {AUDIT_LOG_INDEX}: {e}")
+
+
+def parse_audit_timestamp(value):
+    """Audit timestamp as an aware datetime; naive (legacy) values are read as IST. None if unparseable."""
+    try:
+        ts = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+    return ts if ts.tzinfo else ts.replace(tzinfo=LEGACY_TIMEZONE)
+
+
+def audit_entry_id(doc_id, entry):
+    """
+    Deterministic _id for an audit entry, so the live mirror and the backfill
+    write the same entry to the same document instead of duplicating it.
+    """
+    key = "|".join(str(entry.get(k, "")) for k in ("timestamp", "user", "action", "details"))
+    return hashlib.md5(f"{doc_id}|{key}".encode("utf-8")).hexdigest()
+
+
+def audit_log_doc(doc_id, entry):
+    """Audit log copy of an entry, tagged with the group it belongs to."""
+    return dict(entry, doc_id=doc_id)
+
+
+def backfill_audit_log(client, source_index="pega-analysis-results"):
+    """
+    Copy the audit_history entries embedded in the group documents into AUDIT_LOG_INDEX.
+    Idempotent: entries keep their audit_entry_id, and ones already present are skipped (create op).
+    Legacy naive timestamps are stored with their IST offset so they sort with the newer UTC ones.
+    Returns the number of entries added; failures are logged, not raised.
+    """
+    def actions():
+        hits = helpers.scan(
+            client,
+            index=source_index,
+            query={"query": {"exists": {"field": "audit_history"}}, "_source": ["audit_history"]},
+            size=500
+        )
+        for hit in hits:
+            for entry in hit["_source"].get("audit_history") or []:
+                ts = parse_audit_timestamp(entry.get("timestamp"))
+                doc = audit_log_doc(hit["_id"], dict(entry, timestamp=ts.isoformat() if ts else entry.get("timestamp")))
+                yield {
+                    "_op_type": "create",
+                    "_index": AUDIT_LOG_INDEX,
+                    # Id from the entry as originally written, matching the live mirror
+                    "_id": audit_entry_id(hit["_id"], entry),
+                    "_source": doc
+                }
+
+    try:
+        added, errors = helpers.bulk(client, actions(), raise_on_error=False, chunk_size=500)
+        # 409s are entries copied by an earlier backfill or the live mirror
+        failed = [item for item in errors if next(iter(item.values()), {}).get("status") != 409]
+        if failed:
+            print(f"Audit log backfill: {len(failed)} entries failed")
+        return added
+    except Exception as e:
+        print(f"Audit log backfill failed: {e}")
+        return 0
@@ -1,49 +1,130 @@
 import os
+import time
 import asyncio
 from dotenv import load_dotenv
 from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.callbacks import AsyncCallbackHandler
 from langchain.agents import create_tool_calling_agent, AgentExecutor
 
 # Load env variables if not already loaded (dashboard likely loaded them, but good for safety)
 load_dotenv()
 
+# Print agent steps and log tool events to OpenSearch only when explicitly enabled (DIAGNOSIS_VERBOSE=1 or VERBOSE_AGENT=1)
+_VERBOSE = "1" in (os.getenv("DIAGNOSIS_VERBOSE"), os.getenv("VERBOSE_AGENT"))
+
+_MCP_SERVER_CONFIG = {
+    "opensearch": { 
+        "url": os.getenv("MCP_SERVER_URL", "http://localhost:9900/sse"),
+        "transport": "sse",
+        "headers": {
+            "Content-Type": "application/json",
+            "Accept-Encoding": "identity",
+        }
+    }
+}
+
+# Default chat memory window (turns) so long conversations don't keep growing the prompt
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", "8"))
+
+# The MCP tool list rarely changes, so it is fetched at most once per TTL instead of on every chat turn
+_MCP_TOOLS_CACHE = {"tools": None, "ts": 0.0}
+_MCP_TTL = float(os.getenv("MCP_TOOLS_TTL", "300"))
+
+async def _get_mcp_tools():
+    """
+    Returns the OpenSearch MCP tools, refreshing the cached list once it is older than MCP_TOOLS_TTL.
+    The tools open their own session per call, so a cached list is safe to share across event loops.
+    """
+    now = time.monotonic()
+    if _MCP_TOOLS_CACHE["tools"] is None or now - _MCP_TOOLS_CACHE["ts"] > _MCP_TTL:
+        print(f"[DEBUG] MCP_SERVER_URL: {_MCP_SERVER_CONFIG['opensearch']['url']}")
+        client = MultiServerMCPClient(_MCP_SERVER_CONFIG)
+        try:
+            print(f"[DEBUG] Fetching tools from MCP server...")
+            tools = await asyncio.wait_for(client.get_tools(), timeout=15)
+            print(f"[DEBUG] Successfully fetched {len(tools)} tools.")
+        except Exception as e:
+            print(f"[ERROR] Failed to fetch tools: {e}")
+            raise
+        if not tools:
+            return tools
+        _attach_event_callbacks(tools)
+        _MCP_TOOLS_CACHE.update({"tools": tools, "ts": now})
+    return _MCP_TOOLS_CACHE["tools"]
+
+def _attach_event_callbacks(tools):
+    if not _VERBOSE:
+        return
+    import Analysis_Diagnosis
+    callbacks = Analysis_Diagnosis.agent_event_callbacks()
+    for t in tools:
+        t.callbacks = callbacks
+
+def new_chat_memory():
+    """Chat memory that replays only the last CHAT_MEMORY_TURNS exchanges to the LLM."""
+    from langchain.memory import ConversationBufferWindowMemory
+    return ConversationBufferWindowMemory(
+        k=CHAT_MEMORY_TURNS,
+        memory_key="chat_history",
+        return_messages=True,
+        input_key="input",
+        output_key="output"
+    )
+
+class _TokenStreamHandler(AsyncCallbackHandler):
+    """Forwards LLM tokens, and optionally tool start/end events, to a queue."""
+
+    def __init__(self, tokens, tool_events=False):
+        self.tokens = tokens
+        self.tool_events = tool_events
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if token:
+            self.tokens.put_nowait(token)
+
+    async def on_tool_start(self, serialized, input_str, **kwargs):
+        if self.tool_events:
+            self.tokens.put_nowait(("tool_start", (serialized or {}).get("name") or kwargs.get("name"), input_str))
+
+    async def on_tool_end(self, output, **kwargs):
+        if self.tool_events:
+            self.tokens.put_nowait(("tool_end", kwargs.get("name"), None))
+
+async def astream_tokens(agent_executor, user_input, tool_events=False):
+    """
+    Run the agent once and yield its answer tokens as they arrive.
+    Tokens come straight from the LLM callback instead of astream_events, so no event dict is
+    built per token. With tool_events=True, tool progress is yielded in between as
+    ("tool_start", name, input) / ("tool_end", name, None) tuples, so the consumer renders it.
+    Agent errors are re-raised after the last token.
+    """
+    tokens = asyncio.Queue()
+    handler = _TokenStreamHandler(tokens, tool_events)
+    task = asyncio.create_task(agent_executor.ainvoke({"input": user_input}, config={"callbacks": [handler]}))
+    task.add_done_callback(lambda _: tokens.put_nowait(None))
+    try:
+        while (token := await tokens.get()) is not None:
+            yield token
+        await task
+    finally:
+        # Consumer stopped early: don't leave the agent running
+        if not task.done():
+            task.cancel()
+
 async def initialize_agent_executor(memory=None):
     """
     Initializes and returns an AgentExecutor connected to the OpenSearch MCP server.
     """
-    mcp_url = os.getenv("MCP_SERVER_URL", "http://localhost:9900/sse")
-    print(f"[DEBUG] MCP_SERVER_URL: {mcp_url}")
-    
-    # Connect to OpenSearch MCP
-    mcp_server_config = {
-        "opensearch": { 
-            "url": mcp_url,
-            "transport": "sse",
-            "headers": {
-                "Content-Type": "application/json",
-                "Accept-Encoding": "identity",
-            }
-        }
-    }
-    
-    print(f"[DEBUG] Initializing MultiServerMCPClient...")
-    client = MultiServerMCPClient(mcp_server_config)
-    
-    # Fetch tools asynchronously
-    try:
-        print(f"[DEBUG] Fetching tools from MCP server...")
-        tools = await asyncio.wait_for(client.get_tools(), timeout=15)
-        print(f"[DEBUG] Successfully fetched {len(tools)} tools.")
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch tools: {e}")
-        raise
+    import Analysis_Diagnosis
+
+    # Connect to OpenSearch MCP (tool list cached across calls)
+    tools = await _get_mcp_tools()
     
     if not tools:
         raise ValueError("No tools found from MCP server.")
 
-    model = ChatOpenAI(model="gpt-4o", streaming=True)
+    model = Analysis_Diagnosis.get_llm()
     
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a helpful Log Analysis Assistant. You have access to OpenSearch logs. You usually don't need to mention Tool names. IMPORTANT: Always check the index mapping using get_mapping or similar tools before performing any searches to ensure you use the correct fields. Ensure you build syntactically correct OpenSearch DSL queries relative to the mapping found. When searching for errors or logs, ALWAYS search across 'log.message', 'exception_message', and 'log.exception.exception_message' fields. Do not rely on a single field. Note that 'log.message' and 'exception_message' are text fields, while 'log.level' and 'log.logger_name' are keywords."),
@@ -61,7 +142,7 @@ async def initialize_agent_executor(memory=None):
     agent_executor = AgentExecutor(
         agent=agent,
         tools=tools,
-        verbose=True,
+        verbose=_VERBOSE,
         memory=memory,
         handle_parsing_errors=True,
         return_intermediate_steps=True
@@ -69,30 +150,22 @@ async def initialize_agent_executor(memory=None):
     
     return agent_executor
 
-async def initialize_group_chat_agent(group_id, group_context_str, memory=None):
+async def initialize_group_chat_agent(group_id, group_context_str, memory=None, saved_reports=None):
     """
     Initializes an agent specifically for chatting about a log group.
     Has access to a local tool to update the analysis.
+    Without a caller-supplied memory, only the last CHAT_MEMORY_TURNS exchanges are replayed to the LLM.
+    If the caller passes a saved_reports dict (owned by its session), the tool records
+    group_id -> saved report there, so the UI can show it without re-reading the doc.
     """
     from langchain.tools import tool
     import Analysis_Diagnosis
 
-    mcp_url = os.getenv("MCP_SERVER_URL", "http://localhost:9900/sse")
-    
-    # Connect to OpenSearch MCP
-    mcp_server_config = {
-        "opensearch": { 
-            "url": mcp_url,
-            "transport": "sse",
-            "headers": {
-                "Content-Type": "application/json",
-                "Accept-Encoding": "identity",
-            }
-        }
-    }
-    
-    client = MultiServerMCPClient(mcp_server_config)
-    mcp_tools = await client.get_tools()
+    if memory is None:
+        memory = new_chat_memory()
+
+    # Connect to OpenSearch MCP (tool list cached across calls)
+    mcp_tools = await _get_mcp_tools()
     
     # Define Local Tool for Updating Analysis
     @tool
@@ -105,25 +178,26 @@ async def initialize_group_chat_agent(group_id, group_context_str, memory=None):
         try:
             # We create a fresh client here to ensure thread safety / no loop issues
             os_client = Analysis_Diagnosis.get_opensearch_client()
-            Analysis_Diagnosis.update_diagnosis_in_opensearch(os_client, group_id, new_report)
+            Analysis_Diagnosis.update_diagnosis_in_opensearch(os_client, group_id, new_report, refresh="wait_for")
+            if saved_reports is not None:
+                saved_reports[group_id] = new_report
             return "Successfully updated the diagnosis report in the database."
         except Exception as e:
             return f"Failed to update report: {str(e)}"
 
     # Combine tools
     all_tools = mcp_tools + [update_group_analysis]
+    _attach_event_callbacks([update_group_analysis])
 
-    model = ChatOpenAI(model="gpt-4o", streaming=True)
-    
-    # Escape braces in JSON for LangChain prompt template
-    safe_context_str = group_context_str.replace("{", "{{").replace("}", "}}")
+    model = Analysis_Diagnosis.get_llm()
     
+    # The context JSON is bound as a partial variable below, so its braces never need escaping
     system_prompt = f"""You are a specialized Log Analysis Assistant focusing on a SINGLE Error Group.
     
     CONTEXT_ID: {group_id}
     
     CURRENT GROUP CONTEXT:
-    {safe_context_str}
+    {{group_context}}
     
     Your Goal:
     1. Answer questions about this specific error group.
@@ -147,7 +221,7 @@ async def initialize_group_chat_agent(group_id, group_context_str, memory=None):
         MessagesPlaceholder(variable_name="chat_history"),
         ("human", "{input}"),
         MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ])
+    ]).partial(group_context=group_context_str)
 
     agent = create_tool_calling_agent(
         llm=model,
@@ -158,7 +232,7 @@ async def initialize_group_chat_agent(group_id, group_context_str, memory=None):
     agent_executor = AgentExecutor(
         agent=agent,
         tools=all_tools,
-        verbose=True,
+        verbose=_VERBOSE,
         memory=memory,
         handle_parsing_errors=True,
         return_intermediate_steps=True
@@ -1,67 +1,123 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import os
 import time
 import re
+import hmac
+import hashlib
 from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 import asyncio
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import chat_agent
-from opensearchpy import OpenSearch, helpers
+from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
 import json
+import orjson
+from opensearch_serializer import OrjsonSerializer
+import audit_log
+from audit_log import AUDIT_LOG_INDEX
 from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-CHAT_HISTORY_FILE = "chat_history.json"
+# --- Brand Images ---
+LOGO_PATH = "assets/logo.jpg"
+AGENT_LOGO_PATH = "assets/agent_logo.png"
+
+@st.cache_resource
+def load_asset(path):
+    """Image file bytes, read once per server process (None when the file is missing)."""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+LOGO_IMAGE = load_asset(LOGO_PATH)
+# Chat avatar: the agent logo, falling back to the app logo
+ASSISTANT_AVATAR = load_asset(AGENT_LOGO_PATH) or LOGO_IMAGE
 
 # --- Timezone Helper ---
-def apply_timezone_conversion(df, col_name, timezone_option):
+DISPLAY_TIMEZONES = {"IST": "Asia/Kolkata", "PST": "US/Pacific"}
+
+IST = ZoneInfo("Asia/Kolkata")
+
+def utc_now_iso():
+    """Current time in UTC as an ISO string with its offset (used for audit entries; shown in IST)."""
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+def set_display_timezone(df, last_seen_by_tz, timezone_option):
     """
-    Convert a dataframe column from UTC to selected timezone.
-    Assumes source is UTC (default from OpenSearch).
+    Swap df's last_seen for the column precomputed in the chosen display timezone
+    (see fetch_detailed_table_data_enriched); rows are aligned on the index.
     """
-    if df.empty or col_name not in df.columns:
+    if df.empty or timezone_option not in last_seen_by_tz:
         return df
-        
-    # Ensure datetime
-    if not pd.api.types.is_datetime64_any_dtype(df[col_name]):
-        df[col_name] = pd.to_datetime(df[col_name], format='mixed', errors='coerce')
-        
-    # Conversion Logic
-    # IST = UTC + 5:30
-    # PST = UTC - 8:00
-    if timezone_option == "IST":
-        df[col_name] = df[col_name] + pd.Timedelta(hours=5, minutes=30)
-    elif timezone_option == "PST":
-        df[col_name] = df[col_name] - pd.Timedelta(hours=8)
-    
-    # If it was already timezone aware, we might need to handle it differently, 
-    # but pd.to_datetime usually returns naive if input is naive ISO.
-    # OpenSearch ISOs differ but usually we treat them as naive UTC for simple shifting.
+    df["last_seen"] = last_seen_by_tz[timezone_option]
     return df
 
-def load_chat_history():
-    """Load chat history from a JSON file."""
-    if os.path.exists(CHAT_HISTORY_FILE):
+# --- Background Event Loop ---
+@st.cache_resource
+def get_background_loop():
+    """Start one long-lived event loop in a daemon thread, shared by all reruns."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-bridge", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """
+    Run a coroutine on the background loop and block until it finishes.
+    The loop is shared by every browser session, so coroutines run here must not touch st.* or
+    session_state: they return plain data and the calling script thread stores or renders it.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()
+
+def iter_async(agen):
+    """
+    Drive an async generator from sync code (e.g. st.write_stream).
+    The generator runs to completion on the background loop, pushing chunks into a queue
+    that this thread drains, instead of one cross-thread round trip per chunk.
+    Like run_async, the generator must yield plain data and leave st.* to the caller.
+    """
+    loop = get_background_loop()
+    chunks = queue.Queue()
+    producer = {}
+
+    async def _drain():
+        producer["task"] = asyncio.current_task()
         try:
-            with open(CHAT_HISTORY_FILE, "r") as f:
-                return json.load(f)
+            async for chunk in agen:
+                chunks.put(("chunk", chunk))
         except Exception as e:
-            st.error(f"Error loading chat history: {e}")
-            return []
-    return []
-
-def save_chat_history(messages):
-    """Save chat history to a JSON file."""
+            chunks.put(("error", e))
+        finally:
+            chunks.put(("done", None))
+
+    async def _stop():
+        # Cancel the producer, let it unwind, then close the generator so its own cleanup runs
+        # (e.g. astream_tokens cancels the agent run)
+        task = producer.get("task")
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await agen.aclose()
+
+    fut = asyncio.run_coroutine_threadsafe(_drain(), loop)
     try:
-        with open(CHAT_HISTORY_FILE, "w") as f:
-            json.dump(messages, f, indent=4)
-    except Exception as e:
-        st.error(f"Error saving chat history: {e}")
-
-# Apply nest_asyncio to allow nested event loops in Streamlit
-import nest_asyncio
-nest_asyncio.apply()
+        while True:
+            kind, value = chunks.get()
+            if kind == "done":
+                break
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        # Consumer stopped early (or failed): stop the producer on the loop too
+        if not fut.done():
+            asyncio.run_coroutine_threadsafe(_stop(), loop)
 
 # Load environment variables
 load_dotenv(override=True)
@@ -81,8 +137,8 @@ def login_page():
     # Centered container for login
     _, col2, _ = st.columns([1, 1, 1])
     with col2:
-        if os.path.exists("assets/logo.jpg"):
-            st.image("assets/logo.jpg", width="stretch")
+        if LOGO_IMAGE:
+            st.image(LOGO_IMAGE, width="stretch")
         else:
             st.header("IdentifAI 2.0")
         
@@ -93,9 +149,14 @@ def login_page():
         
         if st.button("Login", type="primary", width="stretch"):
             env_user = os.getenv("APP_USERNAME", "alamaticz")
-            env_pass = os.getenv("APP_PASSWORD", "Alamaticz#2024")
+            # Prefer the stored SHA-256 hash; fall back to hashing the plain APP_PASSWORD
+            env_pass_hash = os.getenv("APP_PASSWORD_HASH") or hashlib.sha256(
+                os.getenv("APP_PASSWORD", "Alamaticz#2024").encode()
+            ).hexdigest()
+            password_hash = hashlib.sha256(password.encode()).hexdigest()
             
-            if username and password == env_pass:
+            # Constant-time compare so response timing does not leak how much of the hash matched
+            if username and hmac.compare_digest(password_hash, env_pass_hash.strip().lower()):
                 # Allow any username as long as password matches
                 st.session_state.logged_in = True
                 st.session_state.username = username
@@ -132,8 +193,8 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # sidebar logo
-if os.path.exists("assets/logo.jpg"):
-    st.sidebar.image("assets/logo.jpg", width="stretch")
+if LOGO_IMAGE:
+    st.sidebar.image(LOGO_IMAGE, width="stretch")
 
 st.sidebar.markdown("---")
 
@@ -141,6 +202,12 @@ st.sidebar.markdown("---")
 OPENSEARCH_URL = os.getenv("OPENSEARCH_URL")
 OPENSEARCH_USER = os.getenv("OPENSEARCH_USER")
 OPENSEARCH_PASS = os.getenv("OPENSEARCH_PASS")
+OPENSEARCH_POOL_MAXSIZE = int(os.getenv("OPENSEARCH_POOL_MAXSIZE", "16"))
+
+# filter_path presets: return only what the callers read (no _index/_score/shard metadata).
+# Note filter_path drops empty containers, so read results with .get(...) defaults.
+HITS_FILTER_PATH = ["hits.hits._id", "hits.hits._source", "hits.hits.fields", "hits.hits.sort"]
+AGGS_FILTER_PATH = ["aggregations"]
 
 @st.cache_resource
 def get_opensearch_client():
@@ -151,12 +218,21 @@ def get_opensearch_client():
         
     auth = (OPENSEARCH_USER, OPENSEARCH_PASS) if OPENSEARCH_USER else None
     
+    # One pooled client shared by every rerun and the parallel page fetches; gzip keeps the
+    # large detailed-table responses small on the wire
     return OpenSearch(
         hosts=[OPENSEARCH_URL],
         http_auth=auth,
+        connection_class=RequestsHttpConnection,
+        pool_maxsize=OPENSEARCH_POOL_MAXSIZE,
+        http_compress=True,
+        serializer=OrjsonSerializer(),
         verify_certs=False,
         ssl_show_warn=False,
-        timeout=500
+        timeout=500,
+        max_retries=3,
+        retry_on_timeout=True,
+        retry_on_status=(502, 503, 504)
     )
 
 
@@ -164,7 +240,45 @@ def get_opensearch_client():
 
 
 
-def fetch_log_level_distribution(client):
+@st.cache_data(ttl=5, show_spinner=False)
+def is_es_alive(_client):
+    """Cached 2s ping, so a dead cluster fails the page fast without a ping on every rerun."""
+    try:
+        return bool(_client.ping(request_timeout=2))
+    except Exception:
+        return False
+
+# OpenSearch reads are cached across reruns. Writes made from this app bump data_version so
+# the group-level views refetch immediately instead of waiting out the TTL.
+FETCH_CACHE_TTL = 30
+
+@st.cache_resource
+def _data_version_state():
+    """
+    Process-wide write counter. The cached fetchers it keys are shared by every session, so a
+    per-session counter could land on a version another session already cached stale data under.
+    """
+    return {"version": 0, "lock": threading.Lock()}
+
+def bump_data_version():
+    """Invalidate cached pega-analysis-results views after a write."""
+    state = _data_version_state()
+    with state["lock"]:
+        state["version"] += 1
+
+def current_data_version():
+    return _data_version_state()["version"]
+
+def clear_dashboard_cache():
+    """Drop every cached dashboard query so the next render reads fresh data."""
+    for fetch in (calculate_summary_metrics, fetch_detailed_table_data, fetch_detailed_table_data_enriched,
+                  fetch_log_level_distribution,
+                  fetch_diagnosis_status_distribution, fetch_top_error_groups, fetch_recent_errors,
+                  fetch_global_audit_history):
+        fetch.clear()
+
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_log_level_distribution(_client):
     """Fetch distribution of log levels."""
     query = {
         "size": 0,
@@ -175,35 +289,61 @@ def fetch_log_level_distribution(client):
         }
     }
     try:
-        response = client.search(body=query, index="pega-logs")
-        buckets = response['aggregations']['levels']['buckets']
+        response = _client.search(body=query, index="pega-logs", filter_path=AGGS_FILTER_PATH)
+        buckets = response.get('aggregations', {}).get('levels', {}).get('buckets', [])
         return pd.DataFrame(buckets)
     except Exception as e:
         st.error(f"Error fetching log levels: {e}")
         return pd.DataFrame()
 
-def fetch_top_error_groups(client, size=10):
+# Rule name for RuleSequence groups, parsed on the cluster: second "->" token of the first
+# "|" segment of group_signature. Other group types emit nothing.
+DISPLAY_RULE_RUNTIME_MAPPINGS = {
+    "display_rule": {
+        "type": "keyword",
+        "script": {
+            "source": """
+                if (doc['group_type'].size() == 0 || doc['group_type'].value != 'RuleSequence') { return; }
+                def sig = params._source.group_signature;
+                if (sig == null) { return; }
+                int bar = sig.indexOf('|');
+                String first = (bar >= 0 ? sig.substring(0, bar) : sig).trim();
+                int a = first.indexOf('->');
+                if (a < 0) { emit('N/A'); return; }
+                int b = first.indexOf('->', a + 2);
+                emit(b < 0 ? first.substring(a + 2) : first.substring(a + 2, b));
+            """
+        }
+    }
+}
+
+def _hit_display_rule(hit):
+    """display_rule runtime field value, or None when the script emitted nothing."""
+    values = hit.get('fields', {}).get('display_rule')
+    return values[0] if values else None
+
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_top_error_groups(_client, size=10, data_version=0):
     """Fetch top error groups."""
     query = {
         "size": size,
+        "_source": {"includes": ["group_signature", "count", "group_type", "representative_log.logger_name", "diagnosis.status"]},
         "query": {"match_all": {}},
+        "runtime_mappings": DISPLAY_RULE_RUNTIME_MAPPINGS,
+        "fields": ["display_rule"],
         "sort": [{"count": {"order": "desc"}}]
     }
     try:
-        response = client.search(body=query, index="pega-analysis-results")
-        hits = response['hits']['hits']
+        response = _client.search(body=query, index="pega-analysis-results", filter_path=HITS_FILTER_PATH)
+        hits = response.get('hits', {}).get('hits', [])
         data = []
         for hit in hits:
             source = hit['_source']
             
-            # Parse Rule Name for display
+            # Rule Name comes back parsed from the display_rule runtime field
             display_rule = "N/A"
             if source.get('group_type') == "RuleSequence":
-                sig = source.get("group_signature", "")
-                first_part = sig.split('|')[0].strip()
-                tokens = first_part.split('->')
-                if len(tokens) >= 2:
-                    display_rule = tokens[1]
+                display_rule = _hit_display_rule(hit) or "N/A"
             elif source.get('representative_log'):
                 # Fallback to logger name or exception for other types
                 display_rule = source.get('representative_log', {}).get('logger_name', 'N/A')
@@ -215,12 +355,18 @@ def fetch_top_error_groups(client, size=10):
                 "Rule Name": display_rule,
                 "Diagnosis Status": source.get("diagnosis", {}).get("status", "N/A")
             })
-        return pd.DataFrame(data)
+        df = pd.DataFrame(data)
+        if not df.empty:
+            # Truncated signature for the bar chart labels, computed once per cache window
+            sig = df['Group Signature'].astype(str)
+            df['Display Name'] = sig.where(sig.str.len() <= 60, sig.str.slice(0, 60) + '...')
+        return df
     except Exception as e:
         st.error(f"Error fetching top groups: {e}")
         return pd.DataFrame()
 
-def fetch_diagnosis_status_distribution(client):
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_diagnosis_status_distribution(_client, data_version=0):
     """Fetch distribution of diagnosis statuses."""
     try:
         query = {
@@ -231,18 +377,19 @@ def fetch_diagnosis_status_distribution(client):
                 }
             }
         }
-        res = client.search(index="pega-analysis-results", body=query)
-        buckets = res['aggregations']['statuses']['buckets']
+        res = _client.search(index="pega-analysis-results", body=query, filter_path=AGGS_FILTER_PATH)
+        buckets = res.get('aggregations', {}).get('statuses', {}).get('buckets', [])
         return pd.DataFrame(buckets)
     except Exception as e:
         return pd.DataFrame()
 
 
-def fetch_recent_errors(client, start_date=None, end_date=None):
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_recent_errors(_client, start_date=None, end_date=None):
     """Fetch recent errors (simulated trend) - aggregating by time.
     
     Args:
-        client: OpenSearch client
+        _client: OpenSearch client (not hashed by st.cache_data)
         start_date: Optional start date for filtering (datetime object)
         end_date: Optional end date for filtering (datetime object)
     """
@@ -278,8 +425,8 @@ def fetch_recent_errors(client, start_date=None, end_date=None):
         query["query"]["bool"]["must"].append(range_filter)
     
     try:
-        response = client.search(body=query, index="pega-logs")
-        buckets = response['aggregations']['errors_over_time']['buckets']
+        response = _client.search(body=query, index="pega-logs", filter_path=AGGS_FILTER_PATH)
+        buckets = response.get('aggregations', {}).get('errors_over_time', {}).get('buckets', [])
         data = [{"Time": b['key_as_string'], "Count": b['doc_count']} for b in buckets]
         return pd.DataFrame(data)
     except Exception as e:
@@ -287,115 +434,246 @@ def fetch_recent_errors(client, start_date=None, end_date=None):
         return pd.DataFrame()
 
 
-def fetch_detailed_table_data(client, size=5000):
-    """Fetch detailed data for the table."""
+# Page size for PIT + search_after scans of pega-analysis-results
+TABLE_PAGE_SIZE = 1000
+
+def iter_pit_hits(client, index, body, page_size=TABLE_PAGE_SIZE, limit=None, keep_alive="1m"):
+    """
+    Yield hits for a sorted query page by page using a Point-In-Time + search_after.
+    The body's sort must end in a unique tiebreaker (e.g. _id) so pages never overlap.
+    """
+    pit_id = client.create_point_in_time(index=index, keep_alive=keep_alive)["pit_id"]
+    try:
+        page_body = dict(body, pit={"id": pit_id, "keep_alive": keep_alive})
+        returned = 0
+        while limit is None or returned < limit:
+            page_body["size"] = page_size if limit is None else min(page_size, limit - returned)
+            hits = client.search(body=page_body, filter_path=HITS_FILTER_PATH).get('hits', {}).get('hits', [])
+            yield from hits
+            returned += len(hits)
+            if len(hits) < page_body["size"]:
+                break
+            page_body["search_after"] = hits[-1]["sort"]
+    finally:
+        try:
+            client.delete_point_in_time(body={"pit_id": [pit_id]})
+        except Exception:
+            pass
+
+TABLE_SOURCE_FIELDS = [
+    "count", "group_signature", "group_type", "last_seen", "diagnosis.status", "diagnosis.report",
+    "assigned_user", "exception_signatures", "message_signatures", "rules",
+    "representative_log.logger_name", "representative_log.exception_message", "representative_log.message"
+]
+
+def _table_row(hit):
+    """Flatten one pega-analysis-results hit into a row of the detailed table."""
+    src = hit['_source']
+    rep = src.get('representative_log', {})
+    
+    # Helper to join signatures nicely
+    exc_sigs = src.get('exception_signatures', [])
+    msg_sigs = src.get('message_signatures', [])
+    
+    # Use aggregation lists if available, otherwise fallback to representative
+    display_exception = exc_sigs[0] if exc_sigs else rep.get('exception_message', 'N/A')
+    if len(exc_sigs) > 1:
+        display_exception += f" (+{len(exc_sigs)-1} others)"
+    
+    display_message = msg_sigs[0] if msg_sigs else rep.get('message', 'N/A')
+    if len(msg_sigs) > 1:
+        display_message += f" (+{len(msg_sigs)-1} others)"
+
+    # Rule name of a RuleSequence (type->name->func->class | ...), parsed server-side
+    display_rule = _hit_display_rule(hit) or "N/A"
+    
+    return {
+        "doc_id": hit['_id'],
+        "last_seen": src.get('last_seen'),
+        "count": src.get('count'),
+        "diagnosis.status": src.get('diagnosis', {}).get('status', 'PENDING'),
+        "assigned_user": src.get('assigned_user', 'Unassigned'),
+        "group_signature": src.get('group_signature'),
+        "group_type": src.get('group_type'),
+        "display_rule": display_rule,
+        "exception_summary": display_exception,
+        "message_summary": display_message,
+        "logger_name": rep.get('logger_name'),
+        "diagnosis.report": src.get('diagnosis', {}).get('report'),
+        "rules": src.get('rules', [])
+    }
+
+# Table columns matched by the search boxes, concatenated into one hidden column
+SEARCH_COLUMNS = ["display_rule", "exception_summary", "message_summary", "group_type"]
+SEARCH_BLOB_COLUMN = "_search_blob"
+
+def search_mask(df, search_query):
+    """Rows whose rule, exception, message or type contains search_query (case-insensitive)."""
+    return df[SEARCH_BLOB_COLUMN].str.contains(search_query.lower(), na=False, regex=False)
+
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_detailed_table_data(_client, size=None, data_version=0):
+    """Fetch detailed data for the table (all groups unless size is given), paged via PIT + search_after."""
     query = {
-        "size": size,
-        "sort": [{"count": {"order": "desc"}}]
+        # Only the fields _table_row reads; raw_log_ids, audit_history etc. stay on the server
+        "_source": {"includes": TABLE_SOURCE_FIELDS},
+        "runtime_mappings": DISPLAY_RULE_RUNTIME_MAPPINGS,
+        "fields": ["display_rule"],
+        "sort": [{"count": {"order": "desc"}}, {"_id": {"order": "asc"}}]
     }
     try:
-        response = client.search(body=query, index="pega-analysis-results")
-        hits = response['hits']['hits']
-        data = []
-        for hit in hits:
-            src = hit['_source']
-            rep = src.get('representative_log', {})
-            
-            # Helper to join signatures nicely
-            exc_sigs = src.get('exception_signatures', [])
-            msg_sigs = src.get('message_signatures', [])
-            
-            # Use aggregation lists if available, otherwise fallback to representative
-            display_exception = exc_sigs[0] if exc_sigs else rep.get('exception_message', 'N/A')
-            if len(exc_sigs) > 1:
-                display_exception += f" (+{len(exc_sigs)-1} others)"
-            
-            display_message = msg_sigs[0] if msg_sigs else rep.get('message', 'N/A')
-            if len(msg_sigs) > 1:
-                display_message += f" (+{len(msg_sigs)-1} others)"
-
-            # Ruleset name parsing from group signature if it's a RuleSequence
-            display_rule = "N/A"
-            if src.get('group_type') == "RuleSequence":
-                # Extract just the first rule path for display
-                # Format: type->name->func->class | ...
-                first_part = src.get('group_signature', '').split('|')[0].strip()
-                tokens = first_part.split('->')
-                if len(tokens) >= 2:
-                    display_rule = tokens[1] # The Rule Name part
-            
-            data.append({
-                "doc_id": hit['_id'],
-                "last_seen": src.get('last_seen'),
-                "count": src.get('count'),
-                "diagnosis.status": src.get('diagnosis', {}).get('status', 'PENDING'),
-                "assigned_user": src.get('assigned_user', 'Unassigned'),
-                "group_signature": src.get('group_signature'),
-                "group_type": src.get('group_type'),
-                "display_rule": display_rule,
-                "exception_summary": display_exception,
-                "message_summary": display_message,
-                "logger_name": rep.get('logger_name'),
-                "diagnosis.report": src.get('diagnosis', {}).get('report'),
-                "rules": src.get('rules', [])
-            })
+        data = [_table_row(hit) for hit in iter_pit_hits(_client, "pega-analysis-results", query, limit=size)]
         df = pd.DataFrame(data)
         if not df.empty and 'last_seen' in df.columns:
-            df['last_seen'] = pd.to_datetime(df['last_seen'], format='mixed')
+            # OpenSearch emits ISO8601, so the vectorised ISO parser applies (format='mixed' parses per element)
+            df['last_seen'] = pd.to_datetime(df['last_seen'], format='ISO8601', utc=True, errors='coerce')
+        if not df.empty:
+            # Lowercased searchable text, built once per fetch so each keystroke is one str.contains pass
+            cols = [df[c].fillna('').astype(str) for c in SEARCH_COLUMNS]
+            df[SEARCH_BLOB_COLUMN] = cols[0].str.cat(cols[1:], sep='\x1f').str.lower()
         return df
     except Exception as e:
         st.error(f"Error fetching details: {e}")
         return pd.DataFrame()
 
-def update_document_status(client, doc_id, new_status, user="Unknown"):
-    """Update the diagnosis status of a document with audit trail."""
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_detailed_table_data_enriched(_client, data_version=0):
+    """
+    Detailed table plus the aggregates the table UI needs, computed once per fetch:
+    the count column maximum, filter options, a boolean row mask per status and type,
+    and last_seen converted to each display timezone.
+    """
+    df = fetch_detailed_table_data(_client, data_version=data_version)
+    if df.empty:
+        return {"df": df, "count_max": 0, "statuses": [], "types": [], "status_masks": {}, "type_masks": {},
+                "last_seen_by_tz": {}}
+    statuses = df['diagnosis.status'].dropna().unique().tolist()
+    types = df['group_type'].dropna().unique().tolist()
+    return {
+        "df": df,
+        "count_max": int(df['count'].max()),
+        "statuses": statuses,
+        "types": types,
+        "status_masks": {v: (df['diagnosis.status'] == v).to_numpy() for v in statuses},
+        "type_masks": {v: (df['group_type'] == v).to_numpy() for v in types},
+        # last_seen is parsed as UTC; tz_convert only swaps the zone metadata and is DST-correct
+        "last_seen_by_tz": {opt: df['last_seen'].dt.tz_convert(zone) for opt, zone in DISPLAY_TIMEZONES.items()},
+    }
+
+def selection_mask(masks, selected, n_rows):
+    """OR of the precomputed masks for the selected values; an empty selection keeps every row."""
+    if not selected:
+        return np.ones(n_rows, dtype=bool)
+    return np.logical_or.reduce([masks[v] for v in selected])
+
+def fetch_concurrently(tasks, max_workers=5):
+    """Run independent fetch calls in parallel; tasks maps name -> (fn, args, kwargs)."""
+    ctx = get_script_run_ctx()
+
+    def _call(fn, args, kwargs):
+        # Attach the session context so st.cache_data / st.error work in the worker
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futs = {name: ex.submit(_call, fn, args, kwargs) for name, (fn, args, kwargs) in tasks.items()}
+        return {name: f.result() for name, f in futs.items()}
+
+# Update status AND append to history. Kept as one constant string so the cluster's script
+# cache (keyed by source text) compiles it once.
+STATUS_UPDATE_SCRIPT = """
+    ctx._source.diagnosis.status = params.status;
+    ctx._source.assigned_user = params.user;
+    if (ctx._source.audit_history == null) {
+        ctx._source.audit_history = [];
+    }
+    ctx._source.audit_history.add(params.entry);
+"""
+
+# Flat copy of every audit entry (one doc per action) so the audit dialog can sort and
+# page on the cluster instead of flattening audit_history arrays in Python.
+# Index name and mapping are shared with server.py via audit_log.
+@st.cache_resource(show_spinner=False)
+def ensure_audit_log_index(_client):
+    """
+    Create AUDIT_LOG_INDEX with its date-typed mapping and copy in the entries embedded in
+    the groups' audit_history (idempotent), once per process.
+    """
+    audit_log.ensure_audit_log_index(_client)
+    audit_log.backfill_audit_log(_client)
+    return True
+
+def _audit_log_action(doc_id, entry):
+    """Bulk action indexing one audit entry into AUDIT_LOG_INDEX (same _id the backfill would use)."""
+    return {
+        "_op_type": "index",
+        "_index": AUDIT_LOG_INDEX,
+        "_id": audit_log.audit_entry_id(doc_id, entry),
+        "_source": audit_log.audit_log_doc(doc_id, entry)
+    }
+
+def _bulk_with_audit_log(client, actions, **kwargs):
+    """
+    helpers.bulk for group updates sent together with their audit log copies.
+    Only failed group updates raise; a failed audit log copy is logged, since the change itself is saved.
+    """
+    _, errors = helpers.bulk(client, actions, raise_on_error=False, **kwargs)
+    failed = [item for item in errors if next(iter(item.values()), {}).get("_index") != AUDIT_LOG_INDEX]
+    if len(failed) < len(errors):
+        print(f"Failed to write {len(errors) - len(failed)} audit log entries")
+    if failed:
+        raise helpers.BulkIndexError(f"{len(failed)} document(s) failed to update.", failed)
+
+def update_documents_status(client, updates, user="Unknown"):
+    """Apply several (doc_id, new_status) changes with audit trail in one _bulk request."""
     try:
-        # Use a script to update status AND append to history
-        script_source = """
-            ctx._source.diagnosis.status = params.status;
-            ctx._source.assigned_user = params.user;
-            if (ctx._source.audit_history == null) {
-                ctx._source.audit_history = [];
-            }
-            ctx._source.audit_history.add(params.entry);
-        """
-        
-        # IST Timestamp
-        ist_now = (datetime.utcnow() + timedelta(hours=5, minutes=30)).isoformat()
-        
-        audit_entry = {
-            "timestamp": ist_now,
-            "user": user,
-            "action": "STATUS_CHANGE",
-            "details": f"Changed status onto {new_status}"
-        }
+        # UTC Timestamp (the audit dialog converts to IST)
+        now = utc_now_iso()
         
-        client.update(
-            index="pega-analysis-results",
-            id=doc_id,
-            body={
-                "script": {
-                    "source": script_source,
-                    "lang": "painless",
-                    "params": {
-                        "status": new_status,
-                        "entry": audit_entry,
-                        "user": user
-                    }
-                }
+        actions = []
+        for doc_id, new_status in updates:
+            entry = {
+                "timestamp": now,
+                "user": user,
+                "action": "STATUS_CHANGE",
+                "details": f"Changed status onto {new_status}"
             }
-        )
+            actions.append({
+                "_op_type": "update",
+                "_index": "pega-analysis-results",
+                "_id": doc_id,
+                "retry_on_conflict": 3,
+                "script": script_ref(client, "append_status_audit", {
+                    "status": new_status,
+                    "entry": entry,
+                    "user": user
+                })
+            })
+            actions.append(_audit_log_action(doc_id, entry))
+        
+        ensure_audit_log_index(client)
+        # Return once the changes are searchable so the rerun shows them
+        _bulk_with_audit_log(client, actions, refresh="wait_for", chunk_size=500)
+        for doc_id, _ in updates:
+            invalidate_group_source(doc_id)
+        bump_data_version()
         return True
     except Exception as e:
         st.error(f"Error updating status: {e}")
         return False
 
-def fetch_group_samples(client, group_id, max_samples=5):
-    """Fetch sample raw logs for a group ID."""
+def update_document_status(client, doc_id, new_status, user="Unknown"):
+    """Update the diagnosis status of a document with audit trail."""
+    return update_documents_status(client, [(doc_id, new_status)], user=user)
+
+def fetch_group_samples(client, group_id, max_samples=5, group_source=None):
+    """Fetch sample raw logs for a group ID (pass group_source if the group doc is already loaded)."""
     try:
         # 1. Get Group Doc to find raw IDs
-        group_doc = client.get(index="pega-analysis-results", id=group_id)
-        raw_ids = group_doc["_source"].get("raw_log_ids", [])
+        if group_source is None:
+            group_source = client.get(index="pega-analysis-results", id=group_id, _source_includes=["raw_log_ids"])["_source"]
+        raw_ids = group_source.get("raw_log_ids", [])
         
         if not raw_ids:
             return []
@@ -404,25 +682,50 @@ def fetch_group_samples(client, group_id, max_samples=5):
         # Slice to max_samples
         target_ids = raw_ids[:max_samples]
         
-        # Using mget to retrieve docs by ID
-        response = client.mget(index="pega-logs", body={"ids": target_ids})
+        # One ids query; filter_path drops the per-hit metadata we don't use
+        response = client.search(
+            index="pega-logs",
+            body={"size": len(target_ids), "query": {"ids": {"values": target_ids}}},
+            filter_path=HITS_FILTER_PATH
+        )
+        by_id = {hit["_id"]: hit["_source"] for hit in response.get("hits", {}).get("hits", [])}
         
-        samples = []
-        for doc in response.get("docs", []):
-            if doc.get("found"):
-                samples.append(doc["_source"])
-                
-        return samples
+        # Keep the raw_log_ids order (search hits come back in arbitrary order)
+        return [by_id[doc_id] for doc_id in target_ids if doc_id in by_id]
     except Exception as e:
         return []
 
+def get_group_source(client, group_id):
+    """Group document _source, fetched once and reused by every section of the inspection dialog."""
+    key = f"group_src_{group_id}"
+    if key not in st.session_state:
+        st.session_state[key] = client.get(index="pega-analysis-results", id=group_id)['_source']
+    return st.session_state[key]
+
+def invalidate_group_source(group_id):
+    """Drop the cached group document after it has been modified."""
+    st.session_state.pop(f"group_src_{group_id}", None)
+    st.session_state.pop(f"ctx_{group_id}", None)
+    st.session_state.pop(f"agent_exec_{group_id}", None)
+
+def get_group_context(group_id, group_source, pega_response=None):
+    """construct_analysis_context output, memoized per group document and Pega response."""
+    from Analysis_Diagnosis import construct_analysis_context
+    entries = st.session_state.setdefault(f"ctx_{group_id}", [])
+    for src, pega, context in entries:
+        if src is group_source and pega is pega_response:
+            return context
+    context = construct_analysis_context(group_source, pega_response)
+    # Keep at most one other variant (with/without Pega insights) for the same document
+    entries[:] = [e for e in entries if e[0] is group_source][-1:] + [(group_source, pega_response, context)]
+    return context
+
 @st.dialog("🔍 Detailed Group Inspection", width="large")
 def show_inspection_dialog(group_id, row_data, client):
     """
     Dialog to show detailed inspection of a group with Diagnosis capabilities.
     """
-    import asyncio
-    from Analysis_Diagnosis import diagnose_single_group, construct_analysis_context, DEFAULT_PROMPT_TEMPLATE
+    from Analysis_Diagnosis import stream_diagnosis, clean_markdown, DEFAULT_PROMPT_TEMPLATE
 
     # Clear Pega API response only if we're viewing a different group
     # Track which group the current response belongs to
@@ -433,8 +736,18 @@ def show_inspection_dialog(group_id, row_data, client):
         # Different group - clear the old response
         if 'pega_api_response' in st.session_state:
             del st.session_state['pega_api_response']
+        # and refetch this group's document in case it changed since it was last opened
+        invalidate_group_source(group_id)
         st.session_state['pega_api_response_group_id'] = group_id
 
+    # Fetch the group document once; the context preview, diagnosis, chat, samples and comments all reuse it
+    group_source = None
+    group_source_error = None
+    try:
+        group_source = get_group_source(client, group_id)
+    except Exception as e:
+        group_source_error = e
+
     c1, c2 = st.columns([2, 1])
     with c1:
         st.markdown(f"**Rule/Message**: `{row_data.get('display_rule', 'N/A')}`")
@@ -470,7 +783,6 @@ def show_inspection_dialog(group_id, row_data, client):
             current_user = st.session_state.get("username", "Unknown")
             if update_document_status(client, group_id, new_status, user=current_user):
                 st.success(f"Status updated to {new_status}")
-                time.sleep(1)
                 st.rerun()
 
     st.divider()
@@ -578,9 +890,9 @@ def show_inspection_dialog(group_id, row_data, client):
         # Ideally we fetch the "latest" document to get full non-truncated fields if needed, 
         # but for performance let's try to reconstruct from what we have or fetch light doc.
         try:
-             # Fast fetch of single doc source for accurate context Preview
-             fresh_doc = client.get(index="pega-analysis-results", id=group_id)
-             if fresh_doc and '_source' in fresh_doc:
+             if group_source_error:
+                 raise group_source_error
+             if group_source is not None:
                  # Include Pega API response in preview if available
                  pega_response = None
                  if 'pega_api_response' in st.session_state:
@@ -588,18 +900,14 @@ def show_inspection_dialog(group_id, row_data, client):
                      if resp_data.get('status') == 'success':
                          pega_response = resp_data.get('data')
                  
-                 context_preview = construct_analysis_context(fresh_doc['_source'], pega_response)
+                 context_preview = get_group_context(group_id, group_source, pega_response)
                  
                  # Separate display for rules and pega_api_insights if present
-                 rules_data = None
-                 pega_insights = None
-                 
-                 if 'rules' in context_preview:
-                     rules_data = context_preview.pop('rules')
-                 if 'pega_api_insights' in context_preview:
-                     pega_insights = context_preview.pop('pega_api_insights')
+                 # (read without popping: the memoized context is shared with the chat panel)
+                 rules_data = context_preview.get('rules')
+                 pega_insights = context_preview.get('pega_api_insights')
                  
-                 st.json(context_preview) # Show everything else
+                 st.json({k: v for k, v in context_preview.items() if k not in ('rules', 'pega_api_insights')}) # Show everything else
                  
                  if rules_data:
                      st.markdown("**Rules Data (Sent to AI):**")
@@ -637,11 +945,23 @@ def show_inspection_dialog(group_id, row_data, client):
                     else:
                         st.info("ℹ No Pega API response available - analyzing without API insights")
                     
-                    # Run async diagnosis in sync streamlit
-                    diagnosis_text, usage = asyncio.run(diagnose_single_group(client, group_id, user_prompt, pega_response))
+                    # Stream the report into the page as it is generated (saved to OpenSearch when the stream ends)
+                    streamed_parts = []
+
+                    def stream_report():
+                        agen = stream_diagnosis(client, group_id, user_prompt, pega_response, group_source=group_source)
+                        for delta in iter_async(agen):
+                            streamed_parts.append(delta)
+                            yield delta
+
+                    with col_res:
+                        st.write_stream(stream_report())
+                    diagnosis_text = clean_markdown("".join(streamed_parts))
                     
                     if diagnosis_text:
                         st.session_state[f"last_report_{group_id}"] = diagnosis_text
+                        invalidate_group_source(group_id)
+                        bump_data_version()
                         st.success("Diagnosis Complete!")
                         st.rerun()  # Rerun to display the updated report
                     else:
@@ -701,102 +1021,75 @@ def show_inspection_dialog(group_id, row_data, client):
              with st.chat_message("assistant"):
                 try:
                     # Construct Context (reuse logic)
-                    try:
-                        fresh_src = client.get(index="pega-analysis-results", id=group_id)['_source']
-                        context_dict = construct_analysis_context(fresh_src)
-                    except:
-                         context_dict = row_data.to_dict()
+                    if group_source is not None:
+                        context_dict = get_group_context(group_id, group_source)
+                    else:
+                        context_dict = row_data.to_dict()
                     
-                    context_str = json.dumps(context_dict, indent=2)
+                    # Compact orjson output: faster than json.dumps and no indentation whitespace in the prompt
+                    context_str = orjson.dumps(context_dict, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC).decode()
 
-                    # Async Wrapper
-                    try:
-                        loop = asyncio.get_event_loop()
-                    except RuntimeError:
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        
-                    async def run_group_agent(user_input):
-                         # Lazy Memory Init
-                         if mem_key not in st.session_state:
-                              from langchain.memory import ConversationBufferMemory
-                              st.session_state[mem_key] = ConversationBufferMemory(
-                                    memory_key="chat_history",
-                                    return_messages=True,
-                                    input_key="input",
-                                    output_key="output"
-                              )
-                              
-                         executor = await chat_agent.initialize_group_chat_agent(
+                    # Memory and executor live in this session's state, so they are built here in the
+                    # script thread; only the agent run itself goes to the shared background loop
+                    if mem_key not in st.session_state:
+                         st.session_state[mem_key] = chat_agent.new_chat_memory()
+                    
+                    placeholder = st.empty()
+                    placeholder.markdown("⏳ *Thinking...*")
+                         
+                    # Reuse the executor across turns; rebuild only when the group context changes
+                    exec_key = f"agent_exec_{group_id}"
+                    ctx_hash = hash(context_str)
+                    cached_exec = st.session_state.get(exec_key)
+                    if cached_exec is None or cached_exec[0] != ctx_hash:
+                         # Reports saved by this executor's update tool land in this session-owned dict
+                         saved_reports = {}
+                         executor = run_async(chat_agent.initialize_group_chat_agent(
                              group_id=group_id,
                              group_context_str=context_str,
-                             memory=st.session_state[mem_key]
-                         )
-                         
-                         full_res = ""
-                         placeholder = st.empty()
-                         placeholder.markdown("⏳ *Thinking...*")
-                         
-                         print(f"[DEBUG] Starting stream for group {group_id}")
-                         try:
-                             async for event in executor.astream_events({"input": user_input}, version="v1"):
-                                 kind = event["event"]
-                                 
-                                 if kind == "on_tool_start":
-                                      name = event['name']
-                                      placeholder.markdown(f"🛠️ **Executing**: `{name}`")
-                                 
-                                 elif kind == "on_chat_model_stream":
-                                      chunk = event["data"]["chunk"]
-                                      content = chunk.content
-                                      if content:
-                                          full_res += content
-                                          yield content
-                                          
-                                 elif kind == "on_tool_end":
-                                      placeholder.markdown("✅ Tool Finished. Generating response...")
-                                      
-                         except Exception as e:
-                             print(f"[ERROR] Stream failed: {e}")
-                             placeholder.error(f"Error: {e}")
-                         
-                         if not full_res:
-                             print("[WARN] No content received from stream.")
-                             pass
-                         
-                         placeholder.empty()
-                         st.session_state[f"last_response_{group_id}"] = full_res
+                             memory=st.session_state[mem_key],
+                             saved_reports=saved_reports
+                         ))
+                         st.session_state[exec_key] = (ctx_hash, executor, saved_reports)
+                    _, executor, saved_reports = st.session_state[exec_key]
                     
-                    # Sync Bridge
-                    def sync_gen_wrapper(async_gen):
-                        while True:
-                            try:
-                                chunk = loop.run_until_complete(async_gen.__anext__())
-                                yield chunk
-                            except StopAsyncIteration:
-                                break
-                            except Exception as e:
-                                st.error(f"Stream error: {e}")
-                                break
+                    response_parts = []
+
+                    # Sync Bridge: the agent yields plain tokens and tool events; all st.* calls stay in this thread
+                    def stream_group_reply():
+                        print(f"[DEBUG] Starting stream for group {group_id}")
+                        try:
+                            for item in iter_async(chat_agent.astream_tokens(executor, prompt, tool_events=True)):
+                                if isinstance(item, tuple):
+                                    kind, name, _input = item
+                                    placeholder.markdown(f"🛠️ **Executing**: `{name}`" if kind == "tool_start" else "✅ Tool Finished. Generating response...")
+                                    continue
+                                response_parts.append(item)
+                                yield item
+                        except Exception as e:
+                            print(f"[ERROR] Stream failed: {e}")
+                            st.error(f"Stream error: {e}")
+                        
+                        if not response_parts:
+                            print("[WARN] No content received from stream.")
+                        placeholder.empty()
                                 
-                    st.write_stream(sync_gen_wrapper(run_group_agent(prompt)))
+                    st.write_stream(stream_group_reply())
                     
                     # Save Assistant Message
-                    final_res = st.session_state.get(f"last_response_{group_id}")
+                    final_res = "".join(response_parts)
                     if final_res:
                         st.session_state[hist_key].append({"role": "assistant", "content": final_res})
                         
                         # --- Auto Refresh Logic ---
                         if "Successfully updated" in final_res:
                             st.toast("Analysis updated! Refreshing view...", icon="🔄")
-                            time.sleep(1) # Give elasticsearch a moment to index (wait_for_refresh logic ideally, but sleep is okay here)
-                            # Fetch Fresh Report to update local session state immediately
-                            try:
-                                fresh_doc = client.get(index="pega-analysis-results", id=group_id)
-                                new_report = fresh_doc['_source']['diagnosis']['report']
+                            bump_data_version()
+                            invalidate_group_source(group_id)
+                            # The tool wrote with refresh="wait_for" and hands back the saved report, so no sleep or re-read
+                            new_report = saved_reports.pop(group_id, None)
+                            if new_report:
                                 st.session_state[f"last_report_{group_id}"] = new_report
-                            except Exception as e:
-                                print(f"Error fetching fresh report: {e}")
                             
                             st.rerun()
 
@@ -809,14 +1102,8 @@ def show_inspection_dialog(group_id, row_data, client):
     # --- User Comments ---
     st.markdown("### 💬 User Comments")
     
-    # Fetch existing comments (needs fresh fetch usually, or rely on row_data if we add it there)
-    # Let's fetch fresh comments to be sure we don't overwrite with stale data
-    current_comments = ""
-    try:
-        fresh_doc = client.get(index="pega-analysis-results", id=group_id)
-        current_comments = fresh_doc['_source'].get('comments', "")
-    except:
-        pass
+    # Existing comments come from the dialog's group document (refetched after every save)
+    current_comments = (group_source or {}).get('comments', "")
 
     new_comments = st.text_area("Add notes or implementation details...", value=current_comments, height=100)
     
@@ -824,7 +1111,6 @@ def show_inspection_dialog(group_id, row_data, client):
         current_user = st.session_state.get("username", "Unknown")
         if update_document_comments(client, group_id, new_comments, user=current_user):
              st.success("Comments saved!")
-             time.sleep(1)
              st.rerun()
         else:
              st.error("Failed to save comments.")
@@ -834,7 +1120,7 @@ def show_inspection_dialog(group_id, row_data, client):
     # Fetch Samples
     st.markdown("### 📄 Sample Logs")
     with st.spinner("Fetching raw sample logs..."):
-        samples = fetch_group_samples(client, group_id)
+        samples = fetch_group_samples(client, group_id, group_source=group_source)
     
     if samples:
         tabs = st.tabs([f"Log {i+1}" for i in range(len(samples))])
@@ -859,88 +1145,161 @@ def show_inspection_dialog(group_id, row_data, client):
     else:
         st.warning("No raw sample logs found linked to this group (stats-only group or data retention issue).")
 
+# Set comments AND append to audit_history
+COMMENTS_UPDATE_SCRIPT = """
+    ctx._source.comments = params.comments;
+    if (ctx._source.audit_history == null) {
+        ctx._source.audit_history = [];
+    }
+    ctx._source.audit_history.add(params.entry);
+"""
+
+# Scripts registered once as stored scripts, so updates send only the script id and params
+STORED_SCRIPTS = {
+    "append_status_audit": STATUS_UPDATE_SCRIPT,
+    "append_comment_audit": COMMENTS_UPDATE_SCRIPT,
+}
+
+@st.cache_resource(show_spinner=False)
+def ensure_stored_scripts(_client):
+    """put_script every STORED_SCRIPTS entry once per process; False if the cluster refused."""
+    try:
+        for script_id, source in STORED_SCRIPTS.items():
+            _client.put_script(id=script_id, body={"script": {"lang": "painless", "source": source}})
+        return True
+    except Exception as e:
+        print(f"Stored scripts unavailable, sending inline source: {e}")
+        return False
+
+def script_ref(client, script_id, params):
+    """Update script reference by stored id, or the inline source when scripts could not be stored."""
+    if ensure_stored_scripts(client):
+        return {"id": script_id, "params": params}
+    return {"source": STORED_SCRIPTS[script_id], "lang": "painless", "params": params}
+
 def update_document_comments(client, doc_id, comments, user="Unknown"):
     """Update the comments field of a document with audit history."""
     try:
-        # Script update to set comments AND append to audit_history
-        script_source = """
-            ctx._source.comments = params.comments;
-            if (ctx._source.audit_history == null) {
-                ctx._source.audit_history = [];
-            }
-            ctx._source.audit_history.add(params.entry);
-        """
-        
-        # IST Timestamp
-        ist_now = (datetime.utcnow() + timedelta(hours=5, minutes=30)).isoformat()
+        # UTC Timestamp (the audit dialog converts to IST)
+        now = utc_now_iso()
         
         audit_entry = {
-            "timestamp": ist_now,
+            "timestamp": now,
             "user": user,
             "action": "COMMENT_UPDATE",
             "details": "Updated comments/notes"
         }
         
-        client.update(
-            index="pega-analysis-results",
-            id=doc_id,
-            body={
-                "script": {
-                    "source": script_source,
-                    "lang": "painless",
-                    "params": {
-                        "comments": comments,
-                        "entry": audit_entry
-                    }
-                }
-            }
-        )
+        actions = [
+            {
+                "_op_type": "update",
+                "_index": "pega-analysis-results",
+                "_id": doc_id,
+                "retry_on_conflict": 3,
+                "script": script_ref(client, "append_comment_audit", {
+                    "comments": comments,
+                    "entry": audit_entry
+                })
+            },
+            _audit_log_action(doc_id, audit_entry)
+        ]
+        ensure_audit_log_index(client)
+        _bulk_with_audit_log(client, actions, refresh="wait_for")
+        invalidate_group_source(doc_id)
         return True
     except Exception as e:
         st.error(f"Error updating comments: {e}")
         return False
 
 
-def fetch_global_audit_history(client, size=100):
+def _audit_history_frame(history_items, presorted=False):
+    """DataFrame of audit entries with timestamps normalised to IST, newest first (presorted skips the sort)."""
+    df = pd.DataFrame(history_items)
+    
+    if not df.empty:
+        # Older entries were written as naive IST strings; newer ones carry their offset (UTC, earlier +05:30)
+        ts = df['timestamp'].astype(str)
+        naive = ~ts.str.contains(r'(?:Z|[+-]\d\d:?\d\d)$', regex=True)
+        parsed = pd.to_datetime(ts, format='ISO8601', utc=True, errors='coerce')
+        parsed[naive] -= pd.Timedelta(hours=5, minutes=30)
+        df['timestamp'] = parsed.dt.tz_convert(IST)
+        if not presorted:
+            df = df.sort_values('timestamp', ascending=False)
+    
+    return df
+
+def _fetch_embedded_audit_history(client, size):
+    """Flatten the audit_history arrays stored on the group documents (pre audit-log data)."""
+    # Query for documents that HAVE an audit_history field
+    query = {
+        "size": size,
+        "query": {
+            "exists": {"field": "audit_history"}
+        },
+        "_source": ["audit_history", "group_signature"]
+    }
+    
+    resp = client.search(index="pega-analysis-results", body=query, filter_path=HITS_FILTER_PATH)
+    
+    history_items = []
+    for hit in resp.get('hits', {}).get('hits', []):
+        src = hit['_source']
+        sig = src.get('group_signature', 'Unknown Group')
+        for entry in src.get('audit_history', []):
+            # Add context from the parent doc
+            history_items.append(dict(entry, group_signature=sig))
+    return _audit_history_frame(history_items)
+
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_global_audit_history(_client, size=100, data_version=0):
     """
     Fetch the most recent audit history entries from all documents.
     Returns a flattened DataFrame.
     """
+    client = _client
     try:
-        # Query for documents that HAVE an audit_history field
-        query = {
-            "size": size,
-            "query": {
-                "exists": {"field": "audit_history"}
-            },
-            "_source": ["audit_history", "group_signature", "diagnosis.status"]
-        }
-        
-        resp = client.search(index="pega-analysis-results", body=query)
+        # Make sure entries embedded in audit_history before the audit log existed have been copied in
+        ensure_audit_log_index(client)
+
+        # Newest entries straight from the flat audit log, sorted on the cluster
+        try:
+            resp = client.search(
+                index=AUDIT_LOG_INDEX,
+                body={"size": size, "track_total_hits": False, "sort": [{"timestamp": {"order": "desc"}}]},
+                filter_path=["hits.hits._source"]
+            )
+            entries = [hit['_source'] for hit in resp.get('hits', {}).get('hits', [])]
+        except Exception:
+            # Audit log not created yet
+            entries = []
         
-        history_items = []
-        for hit in resp['hits']['hits']:
-            src = hit['_source']
-            sig = src.get('group_signature', 'Unknown Group')
-            # audit_history is a list of dicts
-            audits = src.get('audit_history', [])
-            
-            for entry in audits:
-                # Add context from the parent doc
-                entry_flat = entry.copy()
-                entry_flat['group_signature'] = sig
-                # entry_flat['doc_id'] = hit['_id'] # Optional if needed
-                history_items.append(entry_flat)
+        if not entries:
+            return _fetch_embedded_audit_history(client, size)
         
-        # Convert to DF
-        df = pd.DataFrame(history_items)
+        # Resolve group signatures with one _mget over the distinct groups on this page
+        doc_ids = list(dict.fromkeys(e['doc_id'] for e in entries if e.get('doc_id')))
+        signatures = {}
+        if doc_ids:
+            resp = client.mget(
+                index="pega-analysis-results",
+                body={"ids": doc_ids},
+                _source_includes=["group_signature"],
+                filter_path=["docs._id", "docs._source"]
+            )
+            signatures = {d['_id']: d.get('_source', {}).get('group_signature') for d in resp.get('docs', [])}
         
-        if not df.empty:
-            # Sort by timestamp descending
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df = df.sort_values('timestamp', ascending=False)
-            
-        return df
+        history_items = [
+            {
+                "timestamp": e.get('timestamp'),
+                "user": e.get('user'),
+                "action": e.get('action'),
+                "details": e.get('details'),
+                "group_signature": signatures.get(e.get('doc_id')) or 'Unknown Group'
+            }
+            for e in entries
+        ]
+        # Already newest-first from the cluster sort
+        return _audit_history_frame(history_items, presorted=True)
             
     except Exception as e:
         # st.error(f"Error fetching history: {e}")
@@ -952,7 +1311,7 @@ def show_audit_history_dialog(client):
     st.info("Showing the most recent changes to groups (Status changes, Comments, etc.)")
     
     with st.spinner("Loading history..."):
-        df_history = fetch_global_audit_history(client, size=200)
+        df_history = fetch_global_audit_history(client, size=200, data_version=current_data_version())
     
     if not df_history.empty:
         st.dataframe(
@@ -979,7 +1338,11 @@ def backup_analysis_status(client):
     backup = {}
     try:
         query = {
-            "size": 10000,
+            # Only what restore_analysis_status writes back (diagnosis keeps its report);
+            # raw_log_ids, rules and representative_log stay on the server
+            "_source": {"includes": ["group_signature", "diagnosis", "comments", "audit_history"]},
+            "track_total_hits": False,
+            "sort": [{"_id": {"order": "asc"}}],
             "query": {
                 "bool": {
                      "should": [
@@ -991,8 +1354,8 @@ def backup_analysis_status(client):
                 }
             }
         }
-        res = client.search(index="pega-analysis-results", body=query)
-        for hit in res['hits']['hits']:
+        # Paged with PIT + search_after, so indices above 10k groups are backed up in full
+        for hit in iter_pit_hits(client, "pega-analysis-results", query):
             src = hit['_source']
             sig = src.get('group_signature')
             diag = src.get('diagnosis', {})
@@ -1011,6 +1374,9 @@ def backup_analysis_status(client):
         # Index might not exist
         return {}
 
+# Ids per _mget request when restoring backed-up groups
+RESTORE_MGET_BATCH = 1000
+
 def restore_analysis_status(client, backup_data):
     """
     Restore diagnosis statuses to the new analysis results.
@@ -1020,56 +1386,128 @@ def restore_analysis_status(client, backup_data):
     
     restored_count = 0
     try:
-        # Inefficient but simple: Scan new groups and check if they are in backup
-        query = {"query": {"match_all": {}}}
-        scan = helpers.scan(client, index="pega-analysis-results", query=query)
+        from log_grouper import generate_group_id
+        # Group _ids are derived from the signature, so look up only the backed-up groups
+        # with _mget instead of scanning the whole index
+        ids_by_sig = {sig: generate_group_id(sig) for sig in backup_data}
+        id_list = list(ids_by_sig.values())
+        existing = set()
+        for i in range(0, len(id_list), RESTORE_MGET_BATCH):
+            resp = client.mget(
+                index="pega-analysis-results",
+                body={"ids": id_list[i:i + RESTORE_MGET_BATCH]},
+                _source=False,
+                filter_path=["docs._id", "docs.found"]
+            )
+            existing.update(d["_id"] for d in resp.get("docs", []) if d.get("found"))
         
         bulk_updates = []
         
-        for doc in scan:
-            doc_id = doc['_id']
-            sig = doc['_source'].get('group_signature')
+        for sig, doc_id in ids_by_sig.items():
+            if doc_id not in existing:
+                continue
+            # Restore
+            saved = backup_data[sig]
             
-            if sig in backup_data:
-                # Restore
-                saved = backup_data[sig]
-                
-                # Handle old format (just dict) vs new format (nested)
-                if "diagnosis" in saved:
-                     diag_val = saved["diagnosis"]
-                     comments_val = saved.get("comments", "")
-                     history_val = saved.get("audit_history", [])
-                else:
-                     diag_val = saved # Old format was just the diagnosis dict
-                     comments_val = ""
-                     history_val = []
-                
-                update_body = {
-                    "doc": {
-                        "diagnosis": diag_val, 
-                        "comments": comments_val,
-                        "audit_history": history_val
-                    }
-                }
-                
-                # Add to bulk update
-                action = {
-                    "_op_type": "update",
-                    "_index": "pega-analysis-results",
-                    "_id": doc_id,
-                    "doc": update_body["doc"]
+            # Handle old format (just dict) vs new format (nested)
+            if "diagnosis" in saved:
+                 diag_val = saved["diagnosis"]
+                 comments_val = saved.get("comments", "")
+                 history_val = saved.get("audit_history", [])
+            else:
+                 diag_val = saved # Old format was just the diagnosis dict
+                 comments_val = ""
+                 history_val = []
+            
+            # Add to bulk update
+            action = {
+                "_op_type": "update",
+                "_index": "pega-analysis-results",
+                "_id": doc_id,
+                "doc": {
+                    "diagnosis": diag_val, 
+                    "comments": comments_val,
+                    "audit_history": history_val
                 }
-                bulk_updates.append(action)
-                restored_count += 1
+            }
+            bulk_updates.append(action)
+            restored_count += 1
         
         if bulk_updates:
-            helpers.bulk(client, bulk_updates)
+            helpers.bulk(client, bulk_updates, chunk_size=500)
             
     except Exception as e:
         print(f"Restore failed: {e}")
         
     return restored_count
 
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_custom_patterns(_client):
+    """All saved grouping rules (up to 1000) from pega-custom-patterns."""
+    try:
+        response = _client.search(index="pega-custom-patterns", body={"query": {"match_all": {}}, "size": 1000}, filter_path=HITS_FILTER_PATH)
+        return [hit["_source"] for hit in response.get("hits", {}).get("hits", [])]
+    except Exception:
+        # Index might not exist yet, which is fine
+        return []
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def generate_grouping_pattern(examples, existing_rules_str):
+    """
+    Ask the LLM for a new or updated grouping rule covering the example texts.
+    Cached on (examples, existing rules), so re-analysing the same selection is free.
+    """
+    from langchain_openai import ChatOpenAI
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+
+    llm = ChatOpenAI(model="gpt-4o", temperature=0)
+    
+    prompt = ChatPromptTemplate.from_template(
+        """
+        You are a regex expert for log grouping.
+        
+        **Task**:
+        1. Analyze the following log signatures/messages (represented by {count} examples).
+        2. Checks against these **EXISTING RULES**:
+        {existing_rules}
+        
+        **Decision Logic**:
+        - If the examples **match an existing rule** (or are a minor variation), suggest an **UPDATE** to that rule to cover these new cases.
+        - If the examples represent a **completely new pattern**, suggest a **NEW** rule.
+        
+        **Input Examples**:
+        {examples}
+        
+        Return strictly Valid JSON:
+        {{
+            "action": "UPDATE" or "NEW",
+            "rule_name": "Name of the existing rule OR a descriptive new name",
+            "group_type": "The existing group category OR a new category",
+            "regex_pattern": "The UPDATED python regex (matching old + new) OR a completely NEW regex"
+        }}
+        
+        **Critical Rules for Regex Generation**:
+        1. **Do NOT use placeholders** like `[DATE]`, `[FILE_PATH]`, or `[ID]`. You must use valid regex for them (e.g., `.*?`, `\d+`, `\d{{4}}-\d{{2}}-\d{{2}}`).
+        2. **Target Raw Logs**: The input examples you see might be "Normalized Signatures", but your regex must match the **RAW LOG LINES**.
+           - Raw logs often start with a timestamp (e.g., `2024-01-01 10:00:00 ERROR...`).
+           - **DO NOT** start your regex with `^` unless you explicitly include the timestamp pattern at the start.
+           - Ideally, **start with `.*`** or just the unanchored text to match broadly within the message.
+        3. **Variable Parts**: Use `.*` or `[\d]+` for any dynamic values (IDs, Dates, Paths).
+        4. **Keep Static Parts Exact**: Match the constant error text precisely to avoid false positives.
+        """
+    )
+    chain = prompt | llm | StrOutputParser()
+    result_str = chain.invoke({
+        "count": len(examples), 
+        "examples": "\n".join(examples),
+        "existing_rules": existing_rules_str
+    })
+    
+    # Clean and Parse JSON
+    cleaned_json = result_str.replace("```json", "").replace("```", "").strip()
+    return json.loads(cleaned_json)
+
 # --- Custom CSS ---
 def local_css():
     st.markdown("""
@@ -1136,8 +1574,10 @@ def local_css():
         </style>
     """, unsafe_allow_html=True)
 
-def calculate_summary_metrics(client):
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def calculate_summary_metrics(_client, data_version=0):
     """Calculate summary metrics for the dashboard."""
+    client = _client
     metrics = {
         "total_errors": 0,
         "unique_issues": 0,
@@ -1145,32 +1585,26 @@ def calculate_summary_metrics(client):
         "resolved_issues": 0
     }
     
+    # The three counts go out as one _msearch round trip; a missing index just fails its own slot
+    searches = [
+        ("total_errors", "pega-logs", {"match": {"log.level": "ERROR"}}),
+        ("unique_issues", "pega-analysis-results", {"match_all": {}}),
+        # Resolved Issues (Strictly RESOLVED or IGNORE)
+        ("resolved_issues", "pega-analysis-results", {"terms": {"diagnosis.status": ["RESOLVED", "IGNORE"]}}),
+    ]
+    body = []
+    for _, index, query in searches:
+        body.append({"index": index})
+        body.append({"size": 0, "track_total_hits": True, "query": query})
+    
     try:
-        # Total Errors
-        if client.indices.exists(index="pega-logs"):
-             count_res = client.count(body={"query": {"match": {"log.level": "ERROR"}}}, index="pega-logs")
-             metrics["total_errors"] = count_res["count"]
+        res = client.msearch(body=body, filter_path=["responses.status", "responses.hits.total.value"])
+        for (name, _, _), item in zip(searches, res.get("responses", [])):
+            if item.get("status", 200) == 200:
+                metrics[name] = item.get("hits", {}).get("total", {}).get("value", 0)
         
-        # Unique Issues
-        try:
-             if client.indices.exists(index="pega-analysis-results"):
-                unique_res = client.count(index="pega-analysis-results")
-                metrics["unique_issues"] = unique_res["count"]
-                
-                # Resolved Issues (Strictly RESOLVED or IGNORE)
-                resolved_res = client.count(
-                    index="pega-analysis-results",
-                    body={"query": {"terms": {"diagnosis.status": ["RESOLVED", "IGNORE"]}}}
-                )
-                metrics["resolved_issues"] = resolved_res["count"]
-
-                # Pending Issues (Everything else)
-                metrics["pending_issues"] = metrics["unique_issues"] - metrics["resolved_issues"]
-                
-        except:
-             metrics["unique_issues"] = 0
-             metrics["pending_issues"] = 0
-             metrics["resolved_issues"] = 0
+        # Pending Issues (Everything else)
+        metrics["pending_issues"] = metrics["unique_issues"] - metrics["resolved_issues"]
             
     except Exception as e:
         # st.error(f"Error calculating metrics: {e}")
@@ -1213,8 +1647,8 @@ def show_profile_dialog():
     st.markdown("### Account Details")
     c1, c2 = st.columns([1, 2])
     with c1:
-        if os.path.exists("assets/logo.jpg"):
-             st.image("assets/logo.jpg", width=100)
+        if LOGO_IMAGE:
+             st.image(LOGO_IMAGE, width=100)
         else:
              st.info("No Avatar")
     with c2:
@@ -1279,13 +1713,39 @@ page = st.session_state.active_page
 
 # --- PAGE 1: Dashboard ---
 if page == "Dashboard":
-    st.markdown("### 📊 Pega Log Analysis Dashboard")
+    c_title, c_refresh = st.columns([5, 1])
+    c_title.markdown("### 📊 Pega Log Analysis Dashboard")
+    if c_refresh.button("🔄 Refresh", help=f"Reload data now (queries are cached for {FETCH_CACHE_TTL}s)"):
+        clear_dashboard_cache()
+        st.rerun()
+    # Stop here instead of letting every page query wait out its own timeout
+    if client and not is_es_alive(client):
+        st.error("OpenSearch unreachable — retry in a few seconds.")
+        st.stop()
     if client:
         # Track if a dialog is already opened this run to avoid conflicts
         dialog_opened = False
         
+        # Fetch the independent page queries in parallel: latency is the slowest query, not the sum
+        version = current_data_version()
+        # The trend date pickers render further down; their last values are already in session_state
+        trend_start = st.session_state.get("trend_start_date")
+        trend_end = st.session_state.get("trend_end_date")
+        trend_range = {
+            "start_date": datetime.combine(trend_start, datetime.min.time()) if trend_start else None,
+            "end_date": datetime.combine(trend_end, datetime.min.time()) if trend_end else None,
+        }
+        prefetched = fetch_concurrently({
+            "metrics": (calculate_summary_metrics, (client,), {"data_version": version}),
+            "details": (fetch_detailed_table_data_enriched, (client,), {"data_version": version}),
+            "levels": (fetch_log_level_distribution, (client,), {}),
+            "status": (fetch_diagnosis_status_distribution, (client,), {"data_version": version}),
+            "groups": (fetch_top_error_groups, (client,), {"size": 5, "data_version": version}),
+            "trend": (fetch_recent_errors, (client,), trend_range),
+        }, max_workers=6)
+
         # 1. Summary Metrics (Top)
-        metrics = calculate_summary_metrics(client)
+        metrics = prefetched["metrics"]
         m1, m2, m3, m4 = st.columns(4)
         m1.metric("Total Errors", metrics["total_errors"])
         m2.metric("Unique Issues", metrics["unique_issues"])
@@ -1310,22 +1770,26 @@ if page == "Dashboard":
             if st.button("✨ Analyse Top 5 Errors", help="Run AI Diagnosis on top pending error groups"):
                 with st.spinner("Running AI Diagnosis... (This may take a minute)"):
                     try:
-                        import subprocess
-                        import sys
-                        # Run the diagnosis script as a separate process
-                        result = subprocess.run([sys.executable, "Analysis_Diagnosis.py"], capture_output=True, text=True)
-                        if result.returncode == 0:
-                            st.success("Diagnosis Complete!")
+                        from Analysis_Diagnosis import run_diagnosis_workflow
+                        # Run in-process on the shared background loop: reuses the pooled client
+                        # and the cached agent instead of starting a new interpreter.
+                        # The run returns its own log lines, so other sessions' output is not mixed in
+                        result = run_async(run_diagnosis_workflow(client=client, top_n=5))
+                        run_log = "\n".join(result.get("log", []))
+                        if "error" not in result:
+                            bump_data_version()
+                            st.success(f"Diagnosis Complete! ({result['diagnosed']}/{result['groups']} groups diagnosed)")
                             with st.expander("View Analysis Logs"):
-                                st.text(result.stdout)
+                                st.text(run_log)
                             time.sleep(1)
                             st.rerun()
                         else:
                             st.error("Diagnosis Failed Check logs.")
-                            st.text(result.stderr)
+                            st.text(run_log)
                     except Exception as e:
                         st.error(f"Failed to trigger analysis: {e}")
-        df_details = fetch_detailed_table_data(client)
+        table = prefetched["details"]
+        df_details = table["df"]
         
         if not df_details.empty:
             # Search Bar
@@ -1334,63 +1798,50 @@ if page == "Dashboard":
             # Filters
             f1, f2, f3 = st.columns([1, 1, 1])
             with f1:
-                statuses = df_details['diagnosis.status'].dropna().unique().tolist()
-                selected_statuses = st.multiselect("Filter by Status", statuses, default=[])
+                selected_statuses = st.multiselect("Filter by Status", table["statuses"], default=[])
             with f2:
-                types = df_details['group_type'].dropna().unique().tolist()
-                selected_types = st.multiselect("Filter by Type", types, default=[])
+                selected_types = st.multiselect("Filter by Type", table["types"], default=[])
             with f3:
                  # Timezone Selector
                  timezone_opt = st.radio("Time Zone", ["IST", "PST"], horizontal=True, index=0)
 
             # Apply Timezone Conversion
             if timezone_opt:
-                df_details = apply_timezone_conversion(df_details, "last_seen", timezone_opt)
+                df_details = set_display_timezone(df_details, table["last_seen_by_tz"], timezone_opt)
 
             # Filter Logic: Empty selection implies "All"
-            if not selected_statuses:
-                selected_statuses = statuses
-            if not selected_types:
-                selected_types = types
-            
-            # Base Filters
+            n_rows = len(df_details)
             mask = (
-                (df_details['diagnosis.status'].isin(selected_statuses)) &
-                (df_details['group_type'].isin(selected_types))
+                selection_mask(table["status_masks"], selected_statuses, n_rows) &
+                selection_mask(table["type_masks"], selected_types, n_rows)
             )
             
             # Apply Search Query
             if search_query:
                 # Case-insensitive string search across relevant columns
-                search_mask = (
-                    df_details['display_rule'].astype(str).str.contains(search_query, case=False, na=False, regex=False) |
-                    df_details['exception_summary'].astype(str).str.contains(search_query, case=False, na=False, regex=False) |
-                    df_details['message_summary'].astype(str).str.contains(search_query, case=False, na=False, regex=False) |
-                    df_details['group_type'].astype(str).str.contains(search_query, case=False, na=False, regex=False)
-                )
-                mask = mask & search_mask
+                mask = mask & search_mask(df_details, search_query)
 
             filtered_df = df_details[mask]
             
             # Ensure all existing statuses are in the options
             standard_options = ["PENDING", "IN PROCESS", "RESOLVED", "IGNORE", "DIAGNOSIS COMPLETED"]
-            existing_statuses = df_details['diagnosis.status'].dropna().unique().tolist()
             # Merge and deduplicate, keeping standard options order preferred
-            all_options = list(dict.fromkeys(standard_options + existing_statuses))
+            all_options = list(dict.fromkeys(standard_options + table["statuses"]))
 
             # Add Inspect Column
             if "Inspect" not in filtered_df.columns:
                 filtered_df.insert(0, "Inspect", False)
 
             # Table with editing
-            edited_df = st.data_editor(
+            st.data_editor(
                 filtered_df, 
                 width="stretch",
                 column_config={
                     "Inspect": st.column_config.CheckboxColumn(help="Check to inspect details", width="small", default=False),
                     "doc_id": None, 
+                    SEARCH_BLOB_COLUMN: None,
                     "last_seen": st.column_config.DatetimeColumn("Last Seen", format="D MMM YYYY, h:mm a"),
-                    "count": st.column_config.ProgressColumn("Count", format="%d", min_value=0, max_value=int(df_details['count'].max())),
+                    "count": st.column_config.ProgressColumn("Count", format="%d", min_value=0, max_value=table["count_max"]),
                     "diagnosis.status": st.column_config.SelectboxColumn("Status", options=all_options, required=True),
                     "assigned_user": st.column_config.TextColumn("Assigned User", width="small"),
                     "group_signature": st.column_config.TextColumn("Full Signature", width="small", help="Unique signature defining this group"),
@@ -1407,26 +1858,34 @@ if page == "Dashboard":
                 key="detailed_table"
             )
             
+            # The editor keeps its diff against filtered_df in session_state as {row position: {column: value}},
+            # so only the touched rows are read instead of comparing the whole frame
+            # (positions left over from a wider filter are dropped)
+            edited_rows = {
+                pos: changes
+                for pos, changes in st.session_state.get("detailed_table", {}).get("edited_rows", {}).items()
+                if pos < len(filtered_df)
+            }
+            
             # --- POPUP LOGIC ---
-            inspected_rows = edited_df[edited_df["Inspect"]]
-            if not inspected_rows.empty and not dialog_opened:
+            inspected = sorted(pos for pos, changes in edited_rows.items() if changes.get("Inspect"))
+            if inspected and not dialog_opened:
                 # Show dialog for the first selected
-                row = inspected_rows.iloc[0]
+                row = filtered_df.iloc[inspected[0]]
                 show_inspection_dialog(row['doc_id'], row, client)
                 dialog_opened = True
 
 
             # Detect Changes
-            if not filtered_df.equals(edited_df):
-                diff = edited_df["diagnosis.status"] != filtered_df["diagnosis.status"]
-                changed_rows = edited_df[diff]
-                if not changed_rows.empty:
-                    for index, row in changed_rows.iterrows():
-                        doc_id = row['doc_id']
-                        new_status = row['diagnosis.status']
-                        # When bulk editing, we use the logged in user
-                        current_user = st.session_state.get("username", "Unknown")
-                        update_document_status(client, doc_id, new_status, user=current_user)
+            updates = []
+            for pos, changes in edited_rows.items():
+                new_status = changes.get("diagnosis.status")
+                if new_status is not None and new_status != filtered_df["diagnosis.status"].iat[pos]:
+                    updates.append((filtered_df["doc_id"].iat[pos], new_status))
+            if updates:
+                # When bulk editing, we use the logged in user
+                current_user = st.session_state.get("username", "Unknown")
+                if update_documents_status(client, updates, user=current_user):
                     st.success("Status updated successfully! Refreshing...")
                     st.rerun()
         else:
@@ -1441,25 +1900,21 @@ if page == "Dashboard":
         c1, c2 = st.columns(2)
         with c1:
             st.caption("Log Level Distribution")
-            df_levels = fetch_log_level_distribution(client)
+            df_levels = prefetched["levels"]
             if not df_levels.empty:
                 fig_levels = px.pie(df_levels, values='doc_count', names='key', hole=0.4)
                 st.plotly_chart(fig_levels)
         with c2:
             st.caption("Diagnosis Status")
-            df_status = fetch_diagnosis_status_distribution(client)
+            df_status = prefetched["status"]
             if not df_status.empty:
                 fig_status = px.pie(df_status, values='doc_count', names='key', hole=0.4)
                 st.plotly_chart(fig_status)
 
         # Row 2: Top Groups (Full Width)
         st.caption("Top Error Groups")
-        df_groups = fetch_top_error_groups(client, size=5)
+        df_groups = prefetched["groups"]
         if not df_groups.empty:
-            # Truncate long signatures for cleaner visualization
-            df_groups['Display Name'] = df_groups['Group Signature'].apply(
-                lambda x: str(x)[:60] + '...' if len(str(x)) > 60 else str(x)
-            )
             fig_groups = px.bar(df_groups, y='Display Name', x='Count', orientation='h', 
                                 hover_data=["Group Signature"])
             fig_groups.update_layout(yaxis={'categoryorder':'total ascending'})
@@ -1487,12 +1942,8 @@ if page == "Dashboard":
                 help="Leave empty to show all data until now"
             )
             
-        # Convert date inputs to datetime objects if provided
-        start_dt = datetime.combine(trend_start_date, datetime.min.time()) if trend_start_date else None
-        end_dt = datetime.combine(trend_end_date, datetime.min.time()) if trend_end_date else None
-        
-        # Fetch data with optional date filtering
-        df_trend = fetch_recent_errors(client, start_date=start_dt, end_date=end_dt)
+        # Fetched with the other page queries, using the same date range
+        df_trend = prefetched["trend"]
         
         if not df_trend.empty:
             fig_trend = px.area(df_trend, x='Time', y='Count')
@@ -1504,7 +1955,13 @@ if page == "Dashboard":
 
 # --- PAGE 2: Chat Agent ---
 elif page == "Chat Agent":
-    st.header("💬 AI Assistant")
+    c_chat_title, c_chat_clear = st.columns([5, 1])
+    c_chat_title.header("💬 AI Assistant")
+    if c_chat_clear.button("🧹 Clear Chat", help="Start a new conversation"):
+        # Drop the transcript, the agent memory and the agent built around it
+        for key in ("messages", "agent_memory", "agent_executor"):
+            st.session_state.pop(key, None)
+        st.rerun()
     # Chat History
     # Chat History - In-Memory Only
     if "messages" not in st.session_state:
@@ -1517,17 +1974,9 @@ elif page == "Chat Agent":
         }
         st.session_state.messages.append(welcome_msg)
 
-    # Determine avatar
-    if os.path.exists("assets/agent_logo.png"):
-        assistant_avatar = "assets/agent_logo.png"
-    elif os.path.exists("assets/logo.jpg"):
-        assistant_avatar = "assets/logo.jpg"
-    else:
-        assistant_avatar = None
-
     # Display chat messages
     for message in st.session_state.messages:
-        avatar = assistant_avatar if message["role"] == "assistant" else None
+        avatar = ASSISTANT_AVATAR if message["role"] == "assistant" else None
         with st.chat_message(message["role"], avatar=avatar):
             st.markdown(message["content"])
 
@@ -1537,93 +1986,57 @@ elif page == "Chat Agent":
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        if os.path.exists("assets/agent_logo.png"):
-             avatar_img = "assets/agent_logo.png"
-        elif os.path.exists("assets/logo.jpg"):
-             avatar_img = "assets/logo.jpg"
-        else:
-             avatar_img = None
-
-        with st.chat_message("assistant", avatar=avatar_img):
+        with st.chat_message("assistant", avatar=ASSISTANT_AVATAR):
             # Wrapper for async execution
             try:
-                # Get or create event loop for this thread
-                try:
-                    loop = asyncio.get_event_loop()
-                except RuntimeError:
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-
-                async def run_agent_async(user_input):
-                    # Manage Memory in Session State
-                    if "agent_memory" not in st.session_state:
-                         # Lazy import to avoid circular dep if any
-                         from langchain.memory import ConversationBufferMemory
-                         st.session_state.agent_memory = ConversationBufferMemory(
-                            memory_key="chat_history",
-                            return_messages=True,
-                            input_key="input",
-                            output_key="output"
-                        )
-                    
-                    # Initialize Agent
-                    agent_executor = await chat_agent.initialize_agent_executor(memory=st.session_state.agent_memory)
+                # Memory and executor live in this session's state, so they are built here in the
+                # script thread; only the agent run itself goes to the shared background loop
+                if "agent_memory" not in st.session_state:
+                     # Windowed, so the prompt stops growing with the session
+                     st.session_state.agent_memory = chat_agent.new_chat_memory()
 
-                    # Create a placeholder for status updates
-                    status_placeholder = st.empty()
-                    status_placeholder.markdown("🧠 *Thinking...*")
-                    full_response = ""
+                # Create a placeholder for status updates
+                status_placeholder = st.empty()
+                status_placeholder.markdown("🧠 *Thinking...*")
+
+                # Build the agent once per session; it holds the memory object, so later turns see the history
+                if "agent_executor" not in st.session_state:
+                    st.session_state.agent_executor = run_async(chat_agent.initialize_agent_executor(memory=st.session_state.agent_memory))
+                agent_executor = st.session_state.agent_executor
+
+                response_parts = []
+
+                # Synchronous wrapper: the agent yields plain tokens and tool events; all st.* calls stay in this thread
+                def stream_agent_reply():
                     try:
-                        # Stream events
-                        async for event in agent_executor.astream_events({"input": user_input}, version="v1"):
-                            kind = event["event"]
-                            
-                            if kind == "on_tool_start":
-                                tool_input = event["data"].get("input")
-                                status_placeholder.markdown(f"🛠️ **Executing**: `{event['name']}`\nInput: `{tool_input}`")
-                            elif kind == "on_tool_end":
-                                 # Clear or update status, but don't print persistently
-                                 status_placeholder.markdown(f"✅ **Finished**: `{event['name']}`")
-                            elif kind == "on_chat_model_stream":
-                                content = event["data"]["chunk"].content
-                                if content:
-                                    full_response += content
-                                    yield content
-                    except GeneratorExit:
-                        pass
+                        # Stream answer tokens; tool progress only updates the status line
+                        for item in iter_async(chat_agent.astream_tokens(agent_executor, prompt, tool_events=True)):
+                            if isinstance(item, tuple):
+                                kind, name, tool_input = item
+                                if kind == "tool_start":
+                                    status_placeholder.markdown(f"🛠️ **Executing**: `{name}`\nInput: `{tool_input}`")
+                                else:
+                                    # Clear or update status, but don't print persistently
+                                    status_placeholder.markdown(f"✅ **Finished**: `{name}`")
+                                continue
+                            response_parts.append(item)
+                            yield item
                     except Exception as e:
-                        status_placeholder.error(f"Stream Error: {e}")
+                        err_msg = f"Streaming error: {e}"
+                        if hasattr(e, 'exceptions'):
+                            for idx, sub_e in enumerate(e.exceptions):
+                                err_msg += f"\nSub-exception {idx+1}: {sub_e} (Type: {type(sub_e).__name__})"
+                        st.error(err_msg)
                     
                     status_placeholder.empty() # Clear status
-                    
-                    # Store result in session state for saving
-                    st.session_state.temp_last_response = full_response
-                
-                # Define a synchronous wrapper to drive the async generator
-                def sync_stream_wrapper(async_gen):
-                    while True:
-                        try:
-                            # Fetch next chunk from async generator using the loop
-                            chunk = loop.run_until_complete(async_gen.__anext__())
-                            yield chunk
-                        except StopAsyncIteration:
-                            break
-                        except Exception as e:
-                            err_msg = f"Streaming error: {e}"
-                            if hasattr(e, 'exceptions'):
-                                for idx, sub_e in enumerate(e.exceptions):
-                                    err_msg += f"\nSub-exception {idx+1}: {sub_e} (Type: {type(sub_e).__name__})"
-                            st.error(err_msg)
-                            break
 
                 # Execute streaming using the wrapper
-                st.write_stream(sync_stream_wrapper(run_agent_async(prompt)))
+                st.write_stream(stream_agent_reply())
                 
                 # Save history
-                final_res = st.session_state.get("temp_last_response")
+                final_res = "".join(response_parts)
                 if final_res:
                     st.session_state.messages.append({"role": "assistant", "content": final_res})
-                    del st.session_state.temp_last_response
                     
             except Exception as e:
                 st.error(f"An error occurred: {e}")
@@ -1678,20 +2091,21 @@ elif page == "Upload Logs":
                         
 # --- PAGE 4: Grouping Studio ---
 elif page == "Grouping Studio":
-    st.header("🎨 Grouping Studio")
+    c_gs_title, c_gs_refresh = st.columns([5, 1])
+    c_gs_title.header("🎨 Grouping Studio")
+    if c_gs_refresh.button("🔄 Refresh", key="gs_refresh", help=f"Reload the group table now (cached for {FETCH_CACHE_TTL}s)"):
+        fetch_detailed_table_data.clear()
+        fetch_detailed_table_data_enriched.clear()
+        st.rerun()
     st.info("Define custom grouping patterns based on examples.")
     
-    # Imports for LLM
-    from langchain_openai import ChatOpenAI
-    from langchain_core.prompts import ChatPromptTemplate
-    from langchain_core.output_parsers import StrOutputParser
-    
     st.subheader("1. Find Similar Groups")
     search_query = st.text_input("Search Logs / Groups", placeholder="Filter by Message, Exception or Rule...")
     
     if client:
         # Fetch detailed data (Same as Dashboard Page)
-        df_details = fetch_detailed_table_data(client, size=5000)
+        table = fetch_detailed_table_data_enriched(client, data_version=current_data_version())
+        df_details = table["df"]
         
         if not df_details.empty:
             # --- Selection State Management ---
@@ -1733,19 +2147,6 @@ elif page == "Grouping Studio":
             # If we are re-rendering with a new key, this column value effectively resets the editor state
             df_details.insert(0, "Select", default_select)
 
-            # Client-side Filtering based on Search Query
-            if search_query:
-                # Case-insensitive string search across relevant columns
-                mask = (
-                    df_details['display_rule'].astype(str).str.contains(search_query, case=False, na=False, regex=False) |
-                    df_details['exception_summary'].astype(str).str.contains(search_query, case=False, na=False, regex=False) |
-                    df_details['message_summary'].astype(str).str.contains(search_query, case=False, na=False, regex=False) |
-                    df_details['group_type'].astype(str).str.contains(search_query, case=False, na=False, regex=False)
-                )
-                filtered_df = df_details[mask]
-            else:
-                filtered_df = df_details
-
             # Timezone Selector (Placed above table or near search?)
             # Let's put it in a column next to search or buttons to save space, or just above table.
             # Reuse columns from buttons row if possible or new row.
@@ -1755,12 +2156,18 @@ elif page == "Grouping Studio":
                  gs_timezone_opt = st.radio("Time Zone", ["IST", "PST"], horizontal=True, key="gs_tz_opt")
             
             if gs_timezone_opt:
-                 filtered_df = apply_timezone_conversion(filtered_df, "last_seen", gs_timezone_opt)
+                 df_details = set_display_timezone(df_details, table["last_seen_by_tz"], gs_timezone_opt)
+
+            # Client-side Filtering based on Search Query
+            if search_query:
+                # Case-insensitive string search across relevant columns
+                filtered_df = df_details[search_mask(df_details, search_query)]
+            else:
+                filtered_df = df_details
 
             # Ensure Status options are present for the Selectbox config (reuse logic)
             standard_options = ["PENDING", "IN PROCESS", "RESOLVED", "IGNORE", "DIAGNOSIS COMPLETED"]
-            existing_statuses = df_details['diagnosis.status'].dropna().unique().tolist()
-            all_options = list(dict.fromkeys(standard_options + existing_statuses))
+            all_options = list(dict.fromkeys(standard_options + table["statuses"]))
 
             # Render Table exactly like Dashboard but with Select column
             # Use dynamic key to force reset on Select All/Deselect All
@@ -1770,8 +2177,9 @@ elif page == "Grouping Studio":
                 column_config={
                     "Select": st.column_config.CheckboxColumn(required=True),
                     "doc_id": None, 
+                    SEARCH_BLOB_COLUMN: None,
                     "last_seen": st.column_config.DatetimeColumn("Last Seen", format="D MMM YYYY, h:mm a"),
-                    "count": st.column_config.ProgressColumn("Count", format="%d", min_value=0, max_value=int(df_details['count'].max())),
+                    "count": st.column_config.ProgressColumn("Count", format="%d", min_value=0, max_value=table["count_max"]),
                     "diagnosis.status": st.column_config.SelectboxColumn("Status", options=all_options, required=True),
                     "assigned_user": st.column_config.TextColumn("Assigned User", width="small"),
                     "group_signature": st.column_config.TextColumn("Full Signature", width="small", help="Unique signature defining this group"),
@@ -1798,20 +2206,13 @@ elif page == "Grouping Studio":
                 st.subheader("2. Analyze Pattern")
                 
                 # Prepare Safe Payload
-                examples = []
-                for index, row in selected_rows.iterrows():
-                    # For Analysis Results, we prefer Exception Summary or full Signature
-                    sig = row.get("group_signature")
-                    exc = row.get("exception_summary")
-                    msg = row.get("message_summary")
-                    
-                    # Heuristic: Send the most descriptive text
-                    if exc and exc != "N/A":
-                        examples.append(exc)
-                    elif msg and msg != "N/A":
-                        examples.append(msg)
-                    else:
-                        examples.append(sig)
+                # For Analysis Results, we prefer Exception Summary or full Signature
+                # Heuristic: Send the most descriptive text (exception, else message, else signature)
+                exc = selected_rows["exception_summary"]
+                msg = selected_rows["message_summary"]
+                exc_ok = exc.notna() & (exc != "") & (exc != "N/A")
+                msg_ok = msg.notna() & (msg != "") & (msg != "N/A")
+                examples = exc.where(exc_ok, msg.where(msg_ok, selected_rows["group_signature"])).tolist()
                     
                 st.write("Selected Candidates (Normalized):")
                 st.code(json.dumps(examples, indent=2), language="json")
@@ -1819,64 +2220,13 @@ elif page == "Grouping Studio":
                 if st.button("✨ Generate Regex Pattern", key="generate_regex_btn"):
                     with st.spinner("Analyzing patterns & checking existing rules..."):
                         try:
-                            llm = ChatOpenAI(model="gpt-4o", temperature=0)
-                            
-                            # Fetch existing rules from OpenSearch
-                            custom_patterns = []
-                            try:
-                                # Fetch all (up to 1000)
-                                response = client.search(index="pega-custom-patterns", body={"query": {"match_all": {}}, "size": 1000})
-                                custom_patterns = [hit["_source"] for hit in response["hits"]["hits"]]
-                            except Exception as e:
-                                # Index might not exist yet, which is fine
-                                pass
+                            # Existing rules (cached; cleared when a rule is saved)
+                            custom_patterns = fetch_custom_patterns(client)
                             
                             existing_rules_str = json.dumps(custom_patterns, indent=2) if custom_patterns else "[]"
                             
-                            prompt = ChatPromptTemplate.from_template(
-                                """
-                                You are a regex expert for log grouping.
-                                
-                                **Task**:
-                                1. Analyze the following log signatures/messages (represented by {count} examples).
-                                2. Checks against these **EXISTING RULES**:
-                                {existing_rules}
-                                
-                                **Decision Logic**:
-                                - If the examples **match an existing rule** (or are a minor variation), suggest an **UPDATE** to that rule to cover these new cases.
-                                - If the examples represent a **completely new pattern**, suggest a **NEW** rule.
-                                
-                                **Input Examples**:
-                                {examples}
-                                
-                                Return strictly Valid JSON:
-                                {{
-                                    "action": "UPDATE" or "NEW",
-                                    "rule_name": "Name of the existing rule OR a descriptive new name",
-                                    "group_type": "The existing group category OR a new category",
-                                    "regex_pattern": "The UPDATED python regex (matching old + new) OR a completely NEW regex"
-                                }}
-                                
-                                **Critical Rules for Regex Generation**:
-                                1. **Do NOT use placeholders** like `[DATE]`, `[FILE_PATH]`, or `[ID]`. You must use valid regex for them (e.g., `.*?`, `\d+`, `\d{{4}}-\d{{2}}-\d{{2}}`).
-                                2. **Target Raw Logs**: The input examples you see might be "Normalized Signatures", but your regex must match the **RAW LOG LINES**.
-                                   - Raw logs often start with a timestamp (e.g., `2024-01-01 10:00:00 ERROR...`).
-                                   - **DO NOT** start your regex with `^` unless you explicitly include the timestamp pattern at the start.
-                                   - Ideally, **start with `.*`** or just the unanchored text to match broadly within the message.
-                                3. **Variable Parts**: Use `.*` or `[\d]+` for any dynamic values (IDs, Dates, Paths).
-                                4. **Keep Static Parts Exact**: Match the constant error text precisely to avoid false positives.
-                                """
-                            )
-                            chain = prompt | llm | StrOutputParser()
-                            result_str = chain.invoke({
-                                "count": len(examples), 
-                                "examples": "\n".join(examples),
-                                "existing_rules": existing_rules_str
-                            })
-                            
-                            # Clean and Parse JSON
-                            cleaned_json = result_str.replace("```json", "").replace("```", "").strip()
-                            result = json.loads(cleaned_json)
+                            # Same selection + unchanged rule library -> cached answer, no LLM call
+                            result = generate_grouping_pattern(tuple(sorted(examples)), existing_rules_str)
                             
                             # Update Session State
                             st.session_state.generated_pattern = result.get("regex_pattern", "")
@@ -1932,6 +2282,7 @@ elif page == "Grouping Studio":
                                          body=new_rule,
                                          refresh=True
                                      )
+                                     fetch_custom_patterns.clear()
                                      
                                      st.success(f"Rule '{rule_name}' stored successfully! Index updated.")
                                      time.sleep(2)
@@ -1989,30 +2340,54 @@ elif page == "Grouping Studio":
                     try:
                         import subprocess
                         import sys
+                        from collections import deque
                         
                         # Use subprocess to run the parallel version
-                        # equivalent to: python log_grouper.py --ignore-checkpoint --workers 4
+                        # equivalent to: python -u log_grouper.py --ignore-checkpoint --workers 4
+                        # (-u so progress lines arrive as they are printed, not on exit)
                         cmd = [
                             sys.executable, 
+                            "-u",
                             "log_grouper.py", 
                             "--ignore-checkpoint", 
                             "--workers", "4",
                             "--batch-size", "1000"
                         ]
                         
-                        result = subprocess.run(cmd, capture_output=True, text=True)
+                        # The index was just recreated and has no readers yet, so refresh and replicas are off
+                        # for the grouping run only. The context manager restores them (and refreshes) even if the
+                        # script fails or is killed; step 4's writes run after that, never against refresh -1.
+                        from log_grouper import OptimizeIndexSettings, ensure_dest_index
+                        ensure_dest_index(client)
+
+                        # Stream output line by line; keep only the tail for error reporting
+                        output_tail = deque(maxlen=50)
+                        with OptimizeIndexSettings(client, "pega-analysis-results"):
+                            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+                            try:
+                                for line in proc.stdout:
+                                    line = line.strip()
+                                    if line:
+                                        output_tail.append(line)
+                                        status_text.text(f"Step 3/4: {line}")
+                                proc.wait()
+                            finally:
+                                # Script run stopped mid-stream: don't leave the grouper writing with refresh off
+                                if proc.poll() is None:
+                                    proc.kill()
+                                    proc.wait()
                         
-                        if result.returncode != 0:
-                             st.error(f"Grouping Script Failed:\n{result.stderr}")
+                        if proc.returncode != 0:
+                             st.error("Grouping Script Failed:\n" + "\n".join(output_tail))
                              # If it failed, we shouldn't continue to restore potentially
                              st.stop()
                         else:
-                             # print(result.stdout) # Optional debug
                              progress_bar.progress(75)
 
                         # 4. Restore
                         status_text.text("Step 4/4: Restoring manual status labels...")
                         restored_count = restore_analysis_status(client, backup_data)
+                        bump_data_version()
                         progress_bar.progress(100)
                         
                         status_text.text("Done!")
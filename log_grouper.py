@@ -31,6 +31,8 @@ SOURCE_INDEX = "pega-logs"
 DEST_INDEX = "pega-analysis-results"
 CHECKPOINT_INDEX = "pega-grouper-checkpoint"
 CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "2500"))
+# Bulk requests in flight per worker when flushing a batch of group upserts
+BULK_THREADS = int(os.getenv("BULK_THREADS", "4"))
 
 # --- Optimization Helpers ---
 
@@ -333,27 +335,29 @@ def update_checkpoint(client, timestamp):
     except Exception as e:
         print(f"[WARN] Failed to update checkpoint: {e}")
 
-def safe_bulk(client, actions, retries=3, backoff=1.0):
+def safe_bulk(client, actions, retries=3, backoff=1.0, thread_count=BULK_THREADS):
     """
-    Wrapper around helpers.bulk with retry logic for transient errors.
+    Send actions with helpers.parallel_bulk (thread_count chunks in flight), retrying transient errors.
+    Returns (success_count, errors) like helpers.bulk.
     """
+    # Split the batch evenly over the threads so a single flush actually runs in parallel
+    chunk_size = max(1, min(CHUNK_SIZE, -(-len(actions) // thread_count)))
     for attempt in range(retries):
         try:
-            return helpers.bulk(
-                client,
-                actions,
-                raise_on_error=False,
-                raise_on_exception=False,
-                start_response_length=True # Optimization? Removed threading but this is for helpers.bulk
-            )
-        except TypeError:
-            # Fallback for start_response_length if not supported
-             return helpers.bulk(
+            success, errors = 0, []
+            for ok, item in helpers.parallel_bulk(
                 client,
                 actions,
+                thread_count=thread_count,
+                chunk_size=chunk_size,
                 raise_on_error=False,
                 raise_on_exception=False
-            )
+            ):
+                if ok:
+                    success += 1
+                else:
+                    errors.append(item)
+            return success, errors
         except Exception as e:
             if attempt == retries - 1:
                 raise
@@ -392,6 +396,29 @@ def save_failed_batch(actions, errors, filename="failed_groups.jsonl"):
         except Exception as e:
              print(f"[ERROR] Failed to write failure log: {e}")
 
+def ensure_dest_index(client):
+    """Create the destination index with its mappings if it does not exist yet."""
+    if not client.indices.exists(index=DEST_INDEX):
+        try:
+            print(f"[INFO] Creating destination index: {DEST_INDEX}")
+            client.indices.create(index=DEST_INDEX, body={
+                "mappings": {
+                    "properties": {
+                        "group_signature": {"type": "text"},
+                        "group_type": {"type": "keyword"},
+                        "first_seen": {"type": "date"},
+                        "last_seen": {"type": "date"},
+                        "count": {"type": "long"},
+                        "raw_log_ids": {"type": "keyword"},
+                        "exception_signatures": {"type": "keyword"},
+                        "message_signatures": {"type": "keyword"},
+                        "diagnosis.status": {"type": "keyword"}
+                    }
+                }
+            })
+        except Exception:
+            pass # Likely created by another worker
+
 # --- Worker Function for Multiprocessing ---
 def worker_process(slice_id, max_slices, limit, batch_size, ignore_checkpoint, session_id):
     """
@@ -418,26 +445,7 @@ def process_logs(limit=None, batch_size=5000, ignore_checkpoint=False, session_i
         return
 
     # Ensure destination index exists (Race condition safe-ish if we rely on existing)
-    if not client.indices.exists(index=DEST_INDEX):
-        try:
-            print(f"[INFO] Creating destination index: {DEST_INDEX}")
-            client.indices.create(index=DEST_INDEX, body={
-                "mappings": {
-                    "properties": {
-                        "group_signature": {"type": "text"},
-                        "group_type": {"type": "keyword"},
-                        "first_seen": {"type": "date"},
-                        "last_seen": {"type": "date"},
-                        "count": {"type": "long"},
-                        "raw_log_ids": {"type": "keyword"},
-                        "exception_signatures": {"type": "keyword"},
-                        "message_signatures": {"type": "keyword"},
-                        "diagnosis.status": {"type": "keyword"}
-                    }
-                }
-            })
-        except Exception:
-            pass # Likely created by another worker
+    ensure_dest_index(client)
 
     # 1. Get Checkpoint
     last_checkpoint = get_last_checkpoint(client)
@@ -529,7 +537,7 @@ def process_logs(limit=None, batch_size=5000, ignore_checkpoint=False, session_i
     
     # print(f"[INFO] Processing logs...")
 
-    # We skip OptimizeIndexSettings in workers to avoid race conditions toggling settings
+    # Workers never toggle index settings; only the dashboard's Apply Rules reset wraps a run in OptimizeIndexSettings
     
     # --- New Aggregation Logic ---
     group_buffer = {}
@@ -0,0 +1,31 @@
+"""
+OpenSearch Serializer Module
+orjson-backed drop-in replacement for opensearch-py's stdlib JSONSerializer.
+Shared by every OpenSearch client in the app so large group documents and
+search responses are encoded/decoded in C.
+"""
+
+import orjson
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    JSONSerializer backed by orjson's C encoder/decoder.
+    Large group documents are parsed several times faster than with the stdlib json module.
+    """
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # Pre-serialized bodies (e.g. bulk lines) are passed through untouched, as in JSONSerializer
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode()
+        except orjson.JSONEncodeError as e:
+            raise SerializationError(data, e)
@@ -2,15 +2,18 @@ import os
 import uvicorn
 from fastapi import FastAPI, HTTPException, Form, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from fastapi import Request
 from dotenv import load_dotenv
 from opensearchpy import OpenSearch, helpers
-import pandas as pd
+from opensearch_serializer import OrjsonSerializer
+from audit_log import AUDIT_LOG_INDEX, audit_entry_id, audit_log_doc, backfill_audit_log, ensure_audit_log_index, parse_audit_timestamp
 import json
+import sys
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 
@@ -49,6 +52,7 @@ def get_opensearch_client():
     return OpenSearch(
         hosts=[OPENSEARCH_URL],
         http_auth=auth,
+        serializer=OrjsonSerializer(),
         verify_certs=False,
         ssl_show_warn=False,
         timeout=30,  # Increased to 30 seconds for stability
@@ -96,6 +100,10 @@ async def startup_event():
         try:
             if client.ping():
                 print("✅ OpenSearch connected")
+                # Create the audit log with its explicit mapping before the first write can map it dynamically,
+                # then copy in the entries embedded in audit_history before it existed (idempotent)
+                ensure_audit_log_index(client)
+                backfill_audit_log(client)
             else:
                 print("⚠️  OpenSearch connection failed")
         except Exception as e:
@@ -104,6 +112,12 @@ async def startup_event():
         print("⚠️  OpenSearch client not initialized")
     print("✅ API ready")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the cached diagnosis agent"""
+    if "Analysis_Diagnosis" in sys.modules:
+        await sys.modules["Analysis_Diagnosis"].close_agent()
+
 # --- Endpoint Handlers ---
 
 
@@ -449,6 +463,17 @@ def get_log_details(
     
     return get_cached_or_compute(cache_key, compute_log_details)
 
+def _mirror_audit_entry(doc_id, audit_entry):
+    """
+    Copy an audit entry into the flat audit log shared with the Streamlit dashboard.
+    The group update is already persisted, so a failure here is logged rather than failing the request
+    (a client retry would otherwise append the audit_history entry twice).
+    """
+    try:
+        client.index(index=AUDIT_LOG_INDEX, id=audit_entry_id(doc_id, audit_entry), body=audit_log_doc(doc_id, audit_entry))
+    except Exception as e:
+        print(f"Failed to write audit log entry for {doc_id}: {e}")
+
 @app.post("/api/logs/update-status")
 def update_status(doc_id: str = Form(...), status: str = Form(...), user: str = Form("Unknown")):
     if not client: raise HTTPException(503, "No DB")
@@ -463,11 +488,11 @@ def update_status(doc_id: str = Form(...), status: str = Form(...), user: str =
             ctx._source.audit_history.add(params.entry);
         """
         
-        # IST Timestamp
-        ist_now = (datetime.utcnow() + pd.Timedelta(hours=5, minutes=30)).isoformat()
+        # UTC Timestamp with offset (older entries are naive IST strings)
+        now = datetime.now(timezone.utc).isoformat(timespec="seconds")
         
         audit_entry = {
-            "timestamp": ist_now,
+            "timestamp": now,
             "user": user,
             "action": "STATUS_CHANGE",
             "details": f"Changed status to {status}"
@@ -488,9 +513,10 @@ def update_status(doc_id: str = Form(...), status: str = Form(...), user: str =
                 }
             }
         )
-        return {"success": True}
     except Exception as e:
         raise HTTPException(500, str(e))
+    _mirror_audit_entry(doc_id, audit_entry)
+    return {"success": True}
 
 @app.post("/api/logs/update-comments")
 def update_comments(doc_id: str = Form(...), comments: str = Form(...), user: str = Form("Unknown")):
@@ -505,11 +531,11 @@ def update_comments(doc_id: str = Form(...), comments: str = Form(...), user: st
             ctx._source.audit_history.add(params.entry);
         """
         
-        # IST Timestamp
-        ist_now = (datetime.utcnow() + pd.Timedelta(hours=5, minutes=30)).isoformat()
+        # UTC Timestamp with offset (older entries are naive IST strings)
+        now = datetime.now(timezone.utc).isoformat(timespec="seconds")
         
         audit_entry = {
-            "timestamp": ist_now,
+            "timestamp": now,
             "user": user,
             "action": "COMMENT_UPDATE",
             "details": "Updated comments/notes"
@@ -529,9 +555,10 @@ def update_comments(doc_id: str = Form(...), comments: str = Form(...), user: st
                 }
             }
         )
-        return {"success": True}
     except Exception as e:
         raise HTTPException(500, str(e))
+    _mirror_audit_entry(doc_id, audit_entry)
+    return {"success": True}
 
 @app.get("/api/history")
 def get_history(size: int = 100):
@@ -558,8 +585,10 @@ def get_history(size: int = 100):
                 entry_flat['group_signature'] = sig
                 history_items.append(entry_flat)
         
-        # Sort by timestamp desc
-        history_items.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        # Sort by timestamp desc. Older entries are naive IST strings and newer ones UTC with an offset,
+        # so compare parsed aware datetimes rather than the strings (unparseable ones go last)
+        oldest = datetime.min.replace(tzinfo=timezone.utc)
+        history_items.sort(key=lambda x: parse_audit_timestamp(x.get('timestamp')) or oldest, reverse=True)
         return history_items
             
     except Exception as e:
@@ -620,6 +649,32 @@ async def diagnose_single(doc_id: str, request: Request = None):
     except Exception as e:
         raise HTTPException(500, str(e))
 
+@app.post("/api/analysis/diagnose/{doc_id}/stream")
+async def diagnose_single_stream(doc_id: str, request: Request = None):
+    """
+    Streaming variant of diagnose_single.
+    Emits Server-Sent Events with one token delta per event, followed by a [DONE] marker.
+    """
+    if not client: raise HTTPException(503, "No DB")
+
+    pega_response = None
+    if request:
+        try:
+            body = await request.json()
+            pega_response = body.get('pega_api_response')
+        except:
+            pass
+
+    async def event_stream():
+        try:
+            async for delta in get_analysis_diagnosis_module().stream_diagnosis(client, doc_id, pega_api_response=pega_response):
+                yield f"data: {json.dumps({'token': delta})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/api/analysis/trigger")
 async def trigger_analysis_global():
     # Calling Analysis_Diagnosis.run_diagnosis_workflow()
@@ -769,7 +824,12 @@ async def get_recent_notifications():
                 entry_ts_str = entry.get('timestamp', '')
                 try:
                     entry_ts = datetime.fromisoformat(entry_ts_str.replace('Z', '+00:00'))
-                    if entry_ts.replace(tzinfo=None) >= last_24h:
+                    # Offset-aware entries compare in UTC; legacy naive ones were written in IST
+                    if entry_ts.tzinfo is not None:
+                        entry_ts = entry_ts.astimezone(timezone.utc).replace(tzinfo=None)
+                    else:
+                        entry_ts -= timedelta(hours=5, minutes=30)
+                    if entry_ts >= last_24h:
                         notifications.append({
                             "id": f"audit_{hit['_id']}_{entry_ts_str}",
                             "text": f"{entry.get('user', 'User')} {entry.get('action')}: {sig[:50]}...",
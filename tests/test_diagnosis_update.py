@@ -0,0 +1,26 @@
+import json
+
+import Analysis_Diagnosis
+
+
+class StubClient:
+    """Records update() calls instead of sending them to OpenSearch."""
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, index, id, body, **kwargs):
+        self.updates.append({"index": index, "id": id, "body": body, **kwargs})
+
+
+def test_update_body_has_single_report_key():
+    client = StubClient()
+    Analysis_Diagnosis.update_diagnosis_in_opensearch(client, "group-1", "Root cause: NPE", {"total_tokens": 10})
+
+    assert len(client.updates) == 1
+    body = client.updates[0]["body"]
+    diagnosis = body["doc"]["diagnosis"]
+    assert diagnosis["report"] == "Root cause: NPE"
+    # Serialized once, the body carries exactly one "report" key
+    assert json.dumps(body).count('"report"') == 1
+    assert list(diagnosis).count("report") == 1